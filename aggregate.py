@@ -16,16 +16,31 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
-import re
-import sys
-from typing import Dict, List
+from collections import defaultdict, namedtuple
+from functools import partial
+from typing import Dict, Iterator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+
+from instrumentation import add_metrics_arguments, gathered, instrumented, merge_phases, phase, timed
+from parallel import ordered_map
+from tableio import (STDIO, EncodedChunk, Piece, TableWriter, add_format_argument, encode_chunk, read_chunks,
+                     read_piece, read_table, split_file)
+from transports import DTYPES, LOCAL_TIME_COLS, WINDOW_FREQ, floor_window, parse_delay, parse_local_time
 
 
 def setup_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument('infile', nargs='?', type=argparse.FileType('r'), default=sys.stdin)
+    parser.add_argument('infile', nargs='?', default=STDIO)
+    parser.add_argument('--output', '-o', default=STDIO, help="Output file. Defaults to stdout (only for CSV)")
+    add_format_argument(parser)
+    parser.add_argument('--chunksize', '-c', type=int, default=None,
+                        help="Stream the input in chunks of this many rows instead of loading it at once")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help="Read and aggregate the streamed windows with this many processes (implies --chunksize)")
+    add_metrics_arguments(parser)
     return parser.parse_args()
 
 
@@ -37,58 +52,149 @@ DROP_COLS = [
     "VehicleRef",
     "monitoredCall/DestinationDisplay",
 ]
+# The one-hot encoded columns, in the order in which they appear in the output
+ONE_HOT_COLS = [
+    "OriginRef",
+    "DestinationRef",
+    "monitoredCall/VehicleAtStop",
+    "monitoredCall/StopPointName",
+    "monitoredCall/VisitNumber",
+    "monitoredCall/StopPointRef",
+    "LineDirectionRef",
+    "HeadwayService",
+]
+SCALAR_AGGREGATIONS = {
+    'ClusterLatitude': 'min',
+    'ClusterLongitude': 'min',
+    'dateTimeGroup': 'min',
+    'dateTimeDiff': 'mean',
+    'Delay': 'mean',
+    'Percentage': 'mean',
+    'InPanic': 'sum',
+    'InCongestion': 'sum',
+    'DestinationAimedArrivalTime': 'mean',
+    'OriginAimedDepartureTime': 'mean',
+}
+# The columns of the encoded dataset needed to compute the aggregations
+ENCODED_COLS = ["dateTime", "Cluster", "ClusterLatitude", "ClusterLongitude", "Delay", "Percentage", "InPanic",
+                "InCongestion", "DestinationAimedArrivalTime", "OriginAimedDepartureTime", *ONE_HOT_COLS]
+DEFAULT_CHUNKSIZE = 100_000
+# The output is written a batch at a time, so the format can't be left to pandas (it would drop midnight times)
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 
-def encode_dataset(df: pd.DataFrame):
-    df2 = df.join(pd.get_dummies(df["OriginRef"], prefix="OriginRef", sparse=True))
-    df2 = df2.join(pd.get_dummies(df2["DestinationRef"], prefix="DestinationRef", sparse=True))
-    df2 = df2.join(
-        pd.get_dummies(df2["monitoredCall/VehicleAtStop"], prefix="monitoredCall/VehicleAtStop", sparse=True))
-    df2 = df2.join(
-        pd.get_dummies(df2["monitoredCall/StopPointName"], prefix="monitoredCall/StopPointName", sparse=True))
-    df2 = df2.join(pd.get_dummies(df2["monitoredCall/VisitNumber"], prefix="monitoredCall/VisitNumber", sparse=True))
-    df2 = df2.join(pd.get_dummies(df2["monitoredCall/StopPointRef"], prefix="monitoredCall/StopPointRef", sparse=True))
-    df2["Delay"] = df2["Delay"].map(lambda x: int(re.sub(r"(-?)PT(\d+)S", r"\1\2", x)))
-    df2["LineDirectionRef"] = df2["LineRef"] + ":" + df["DirectionRef"].astype("string")
+def encode_dataset(df: pd.DataFrame, categories: Dict[str, pd.Index] = None):
+    """Encode the categorical columns and normalize the others.
+
+    The columns in ONE_HOT_COLS become categoricals. If ``categories`` is given, each column in it uses exactly those
+    values, so that separately encoded chunks of the same dataset share the same codes.
+    """
+    categories = categories or {}
+    df2 = df.copy()
+    df2["Delay"] = parse_delay(df2["Delay"])
+    df2["LineDirectionRef"] = line_direction_ref(df2)
     df2.drop(columns=["LineRef", "DirectionRef"], inplace=True)
-    df2 = df2.join(pd.get_dummies(df2["LineDirectionRef"], prefix="LineDirectionRef", sparse=True))
-    # TODO: Check if one hot encoding is the right thing to do. It is the same as counting the "1s"
-    df2 = df2.join(pd.get_dummies(df2["HeadwayService"], prefix="HeadwayService", sparse=True))
-    df2["DestinationAimedArrivalTime"] = df2["DestinationAimedArrivalTime"].map(lambda x: x.tz_localize(None))
-    df2["OriginAimedDepartureTime"] = df2["OriginAimedDepartureTime"].map(lambda x: x.tz_localize(None))
-    return df2.sort_values('dateTime')
+    for col in ONE_HOT_COLS:
+        df2[col] = df2[col].astype(pd.CategoricalDtype(categories.get(col)))
+    for col in LOCAL_TIME_COLS:
+        df2[col] = parse_local_time(df2[col])
+    # A stable sort keeps rows with the same timestamp in file order, whether the file is read at once or in chunks
+    return df2.sort_values('dateTime', kind='mergesort')
 
 
-def get_vectorial_aggregations(columns: List[str]) -> Dict[str, str]:
-    for col in columns:
-        if col.startswith(('DestinationRef_', 'OriginRef_', 'monitoredCall/VehicleAtStop_',
-                           'monitoredCall/StopPointName_', 'monitoredCall/VisitNumber_',
-                           'monitoredCall/StopPointRef_', 'LineDirectionRef_', 'HeadwayService_')):
-            yield col, 'sum'
+def line_direction_ref(df: pd.DataFrame) -> pd.Series:
+    return df["LineRef"] + ":" + df["DirectionRef"].astype("string")
 
 
-def main():
-    args = setup_args()
-    df = pd.read_csv(args.infile,
-                     usecols=lambda x: x not in DROP_COLS,
-                     dtype={
-                         'HeadwayService': "boolean",
-                         "InCongestion": 'boolean',
-                         'InPanic': 'boolean',
-                         'monitoredCall/VehicleAtStop': 'boolean'
-                     },
-                     parse_dates=["dateTime", "OriginAimedDepartureTime", "DestinationAimedArrivalTime"])
+def one_hot_columns(df: pd.DataFrame) -> List[str]:
+    """Return the names of the one-hot encoded columns of the output, as ``pd.get_dummies`` would name them."""
+    return [f"{col}_{value}" for col in ONE_HOT_COLS for value in df[col].cat.categories]
 
-    # This has some Null values: how can we treat it? We should make this code more general
-    df.drop(labels=df[df["Delay"].isnull()].index, inplace=True)
 
-    df = encode_dataset(df)
+def count_categories(df: pd.DataFrame, windows: pd.Series) -> pd.Series:
+    """Count, for each (TimeWindowID, Cluster), the rows having each value of the one-hot encoded columns.
+
+    This is the sum of the one-hot encoding of the columns, computed from the categorical codes without ever building
+    it. Only the non-zero counts are returned, indexed by (TimeWindowID, Cluster, Column), where Column is the position
+    of the value in ``one_hot_columns(df)``.
+    """
+    codes = []
+    offset = 0
+    for col in ONE_HOT_COLS:
+        col_codes = df[col].cat.codes.to_numpy()
+        codes.append(np.where(col_codes >= 0, col_codes.astype('int64') + offset, -1))
+        offset += len(df[col].cat.categories)
+    keys = pd.DataFrame({
+        'TimeWindowID': np.tile(windows.to_numpy(), len(ONE_HOT_COLS)),
+        'Cluster': np.tile(df['Cluster'].to_numpy(), len(ONE_HOT_COLS)),
+        'Column': np.concatenate(codes),
+    })
+    return keys[keys['Column'] >= 0].groupby(['TimeWindowID', 'Cluster', 'Column']).size()
+
+
+def aggregate_batches(agg: pd.DataFrame, counts: pd.Series, columns: List[str],
+                      batch: int = 1000) -> Iterator[pd.DataFrame]:
+    """Yield the aggregated windows, widening the category counts into one column per value a batch at a time."""
+    for start in range(0, len(agg), batch):
+        part = agg.iloc[start:start + batch]
+        windows = part.index.get_level_values('TimeWindowID')
+        wide = counts.loc[windows[0]:windows[-1]].unstack('Column', fill_value=0)
+        wide = wide.reindex(index=part.index, columns=range(len(columns)), fill_value=0)
+        wide.columns = columns
+        yield part.join(wide)
+
+
+def time_window_ids(date_time: pd.Series, start: pd.Timestamp) -> pd.Series:
+    freq = pd.Timedelta(WINDOW_FREQ)
+    minutes = freq // pd.Timedelta(minutes=1)
+    return ((date_time - start) // freq * minutes).astype('int').rename("TimeWindowID")
+
+
+def grouped_diff(df: pd.DataFrame, keys: pd.Series) -> pd.DataFrame:
+    """Subtract from each row the previous row of the same group, as ``df.groupby(keys).diff().fillna(0)`` does.
+
+    If the groups are contiguous (e.g. ``keys`` is sorted) the difference is computed on the whole array at once and
+    the first row of each group is set to 0, otherwise the rows are stably sorted by group first. Either way no
+    per-group frame is created.
+    """
+    values = df.to_numpy(dtype='float64')
+    keys = keys.to_numpy()
 
-    df["dateTimeDiff"] = df["dateTime"].diff().fillna(pd.Timedelta(seconds=0)).dt.total_seconds().astype('int')
+    def group_starts(k: np.ndarray) -> np.ndarray:
+        starts = np.ones(len(k), dtype=bool)
+        starts[1:] = k[1:] != k[:-1]
+        return starts
 
-    indexer = df["dateTime"].sort_values().diff().fillna(pd.Timedelta(seconds=0)).cumsum()
-    grouper = indexer.map(lambda x: x.floor('5T').total_seconds() / 60).astype('int').rename("TimeWindowID")
-    df["dateTimeGroup"] = df["dateTime"].map(lambda x: x.floor(freq='5T'))
+    starts = group_starts(keys)
+    order = None
+    if starts.sum() != len(pd.unique(keys)):
+        order = np.argsort(keys, kind='stable')
+        values = values[order]
+        starts = group_starts(keys[order])
+    diff = np.zeros_like(values)
+    diff[1:] = values[1:] - values[:-1]
+    diff[starts] = 0
+    diff[np.isnan(diff)] = 0
+    if order is not None:
+        unsorted = np.empty_like(diff)
+        unsorted[order] = diff
+        diff = unsorted
+    return pd.DataFrame(diff, index=df.index, columns=df.columns)
+
+
+def add_window_features(df: pd.DataFrame, start: pd.Timestamp, previous: pd.Timestamp = None) -> pd.Series:
+    """Add the per-row features used by the aggregation and return the time window of each row.
+
+    ``df`` must be sorted by ``dateTime``, ``start`` is the first timestamp of the whole dataset and ``previous``
+    the timestamp of the row that precedes ``df`` in it (if any).
+    """
+    diff = df["dateTime"].diff()
+    if previous is not None and not df.empty:
+        diff.iloc[0] = df["dateTime"].iloc[0] - previous
+    df["dateTimeDiff"] = diff.fillna(pd.Timedelta(seconds=0)).dt.total_seconds().astype('int')
+
+    grouper = time_window_ids(df["dateTime"], start)
+    df["dateTimeGroup"] = floor_window(df["dateTime"])
 
     def to_seconds(x: pd.Series) -> pd.Series:
         return (x - pd.Timestamp(0)).dt.total_seconds().astype('int')
@@ -96,27 +202,223 @@ def main():
     df["OriginAimedDepartureTime"] = to_seconds(df["OriginAimedDepartureTime"])
     df["DestinationAimedArrivalTime"] = to_seconds(df["DestinationAimedArrivalTime"])
 
-    converted_times = pd.concat(
-        group[["OriginAimedDepartureTime", "DestinationAimedArrivalTime"]].diff().fillna(0) for _, group in
-        df.groupby(grouper))
-    df[["OriginAimedDepartureTime", "DestinationAimedArrivalTime"]] = converted_times
-
-    grp = df.groupby([grouper, 'Cluster'])
-    agg = grp.aggregate({
-        'ClusterLatitude': 'min',
-        'ClusterLongitude': 'min',
-        'dateTimeGroup': 'min',
-        'dateTimeDiff': 'mean',
-        'Delay': 'mean',
-        'Percentage': 'mean',
-        'InPanic': 'sum',
-        'InCongestion': 'sum',
-        'DestinationAimedArrivalTime': 'mean',
-        'OriginAimedDepartureTime': 'mean',
-        **dict(get_vectorial_aggregations(list(df.columns)))
-    })
-    agg.to_csv(sys.stdout)
-    pass
+    aimed_times = ["OriginAimedDepartureTime", "DestinationAimedArrivalTime"]
+    df[aimed_times] = grouped_diff(df[aimed_times], grouper)
+    return grouper
+
+
+def read_dataset(infile: str, chunksize: int = None, piece: Piece = None, **kwargs):
+    """Read the columns of the clustered dataset used by the aggregation, at once, (with ``chunksize``) in chunks or
+    only a ``piece`` of it (see ``tableio.split_file``)."""
+    kwargs['dtype'] = {**DTYPES, **kwargs.get('dtype', {})}
+    kwargs['columns'] = lambda x: x not in DROP_COLS
+    if piece is not None:
+        return read_piece(infile, piece, parse_dates=["dateTime"], **kwargs)
+    if chunksize:
+        return read_chunks(infile, chunksize, parse_dates=["dateTime"], **kwargs)
+    return read_table(infile, parse_dates=["dateTime"], **kwargs)
+
+
+def aggregate_shard(df: pd.DataFrame, start: pd.Timestamp, previous: pd.Timestamp = None) -> List[pd.DataFrame]:
+    """Aggregate a shard of whole time windows of the encoded dataset, returning the output in batches of rows.
+
+    ``start`` and ``previous`` are the ones of ``add_window_features``, so the shard is aggregated as it would be
+    together with the rest of the dataset.
+    """
+    with phase('window', rows=len(df)):
+        df = df.sort_values('dateTime', kind='mergesort')
+        grouper = add_window_features(df, start, previous)
+    with phase('group', rows=len(df)):
+        agg = df.groupby([grouper, 'Cluster']).aggregate(SCALAR_AGGREGATIONS)
+    with phase('count', rows=len(df)):
+        counts = count_categories(df, grouper)
+    with phase('widen', rows=len(agg)):
+        return list(aggregate_batches(agg, counts, one_hot_columns(df)))
+
+
+def aggregate_writer(outfile: str, fmt: str = None) -> TableWriter:
+    return TableWriter(outfile, fmt=fmt, index=True, date_format=DATE_FORMAT)
+
+
+def aggregate(infile: str, outfile: str, fmt: str = None):
+    with phase('read') as record:
+        df = read_dataset(infile)
+        record.rows = len(df)
+
+    # This has some Null values: how can we treat it? We should make this code more general
+    df.drop(labels=df[df["Delay"].isnull()].index, inplace=True)
+
+    with phase('encode', rows=len(df)):
+        df = encode_dataset(df)
+    with aggregate_writer(outfile, fmt) as writer:
+        for batch in aggregate_shard(df, df["dateTime"].min()):
+            with phase('write', rows=len(batch)):
+                writer.write(batch)
+
+
+SCAN_COLS = ["dateTime", "Delay", "LineRef", "DirectionRef",
+             *(col for col in ONE_HOT_COLS if col != "LineDirectionRef")]
+
+
+class PieceScan(namedtuple("PieceScan", ["dtypes", "uniques", "line_directions", "times"])):
+    """What the first pass of the streaming aggregation finds in a piece of the dataset: the types of its columns, the
+    values of the one-hot encoded ones, and the number of rows with each timestamp (only of the rows with a Delay)."""
+
+
+class DatasetScan(namedtuple("DatasetScan", ["start", "categories", "dtypes", "times", "pieces"])):
+    """The result of the first pass of the streaming aggregation.
+
+    ``times`` is the (sorted) number of rows with each timestamp, ``pieces`` the pieces of the file with the first and
+    the last timestamp of their rows (or None, if they have no rows with a Delay).
+    """
+
+
+def merge_dtypes(a: np.dtype, b: np.dtype) -> np.dtype:
+    if a is None or a == b:
+        return b
+    if is_numeric_dtype(a) and is_numeric_dtype(b) and not is_bool_dtype(a) and not is_bool_dtype(b):
+        return np.result_type(a, b)
+    return np.dtype(object)
+
+
+def scan_piece(infile: str, piece: Piece) -> PieceScan:
+    with phase('scan-piece') as record:
+        chunk = read_piece(infile, piece, columns=SCAN_COLS, dtype=DTYPES, parse_dates=["dateTime"])
+        record.rows = len(chunk)
+        dtypes = chunk.dtypes.to_dict()
+        chunk = chunk[chunk["Delay"].notnull()]
+        uniques = {col: chunk[col].dropna().unique() for col in ONE_HOT_COLS if col in chunk.columns}
+        return PieceScan(dtypes=dtypes, uniques=uniques,
+                         line_directions=chunk[["LineRef", "DirectionRef"]].drop_duplicates(),
+                         times=chunk["dateTime"].value_counts(sort=False))
+
+
+@timed('scan')
+def scan_dataset(infile: str, chunksize: int, jobs: int = 1) -> DatasetScan:
+    """Read the columns that must be known before the aggregation can be streamed.
+
+    These are the first timestamp (the time windows are relative to it), the values of the one-hot encoded columns
+    (each of them becomes an output column) and the timestamps in each piece of the file (of about ``chunksize``
+    rows), that are scanned by ``jobs`` processes.
+    """
+    pieces = split_file(infile, chunksize)
+    uniques = defaultdict(set)
+    dtypes = {}
+    line_directions = [pd.DataFrame(columns=["LineRef", "DirectionRef"])]
+    times = []
+    bounds = []
+    for scan in merge_phases(ordered_map(gathered(scan_piece), ((infile, piece) for piece in pieces), jobs)):
+        for col, dtype in scan.dtypes.items():
+            dtypes[col] = merge_dtypes(dtypes.get(col), dtype)
+        for col, values in scan.uniques.items():
+            uniques[col].update(values)
+        line_directions.append(scan.line_directions)
+        times.append(scan.times)
+        bounds.append((scan.times.index.min(), scan.times.index.max()) if len(scan.times) else None)
+    times = pd.concat(times).groupby(level=0).sum().sort_index() if times else pd.Series(dtype='int64')
+    if times.empty:
+        raise ValueError("The dataset has no rows with a Delay")
+
+    # Read the columns as the whole file would have been read: a column that is integer in some chunks and
+    # floating point in others is a floating point one.
+    dtypes = {col: dtype for col, dtype in dtypes.items() if col not in DTYPES and col != "dateTime"}
+    line_directions = pd.concat(line_directions, ignore_index=True).drop_duplicates()
+    line_directions = line_directions.astype({"DirectionRef": dtypes["DirectionRef"]})
+    uniques["LineDirectionRef"] = set(line_direction_ref(line_directions).dropna())
+    categories = {col: pd.Index(sorted(uniques[col])) for col in ONE_HOT_COLS}
+    categories = {col: values.astype(dtypes[col]) if col in dtypes else values for col, values in categories.items()}
+    return DatasetScan(start=times.index[0], categories=categories, dtypes=dtypes, times=times,
+                       pieces=list(zip(pieces, bounds)))
+
+
+def plan_shards(scan: DatasetScan, shard_rows: int) -> Iterator[Tuple[List[Piece], int, int, Optional[pd.Timestamp]]]:
+    """Group the time windows in shards of about ``shard_rows`` rows, in order.
+
+    Yield, for each shard, the pieces of the file with rows of its windows, its first and last window, and the
+    timestamp of the row before the shard (if any).
+    """
+    timestamps = pd.Series(scan.times.index)
+    windows = time_window_ids(timestamps, scan.start).to_numpy()
+    rows = pd.Series(scan.times.to_numpy()).groupby(windows).sum()
+    # The windows of the first and the last row of each piece
+    pieces = [(piece, *time_window_ids(pd.Series(bounds), scan.start)) for piece, bounds in scan.pieces if bounds]
+
+    def shard(first: int, last: int) -> tuple:
+        position = np.searchsorted(windows, first)
+        previous = timestamps.iloc[position - 1] if position > 0 else None
+        return [piece for piece, low, high in pieces if low <= last and high >= first], first, last, previous
+
+    first = None
+    total = 0
+    for window, count in rows.items():
+        first = window if first is None else first
+        total += count
+        if total >= shard_rows:
+            yield shard(first, window)
+            first = None
+            total = 0
+    if first is not None:
+        yield shard(first, rows.index[-1])
+
+
+def aggregate_pieces(infile: str, pieces: List[Piece], first: int, last: int, previous: Optional[pd.Timestamp],
+                     start: pd.Timestamp = None, categories: Dict[str, pd.Index] = None, dtypes: dict = None,
+                     fmt: str = 'csv') -> List[Tuple[int, EncodedChunk]]:
+    """Read, encode and aggregate the windows from ``first`` to ``last``, from the ``pieces`` of the file with their
+    rows (``start``, ``categories`` and ``dtypes`` are the ones of the scan).
+
+    The output is returned ready to be written in the format ``fmt`` (see ``tableio.encode_chunk``), in batches of
+    rows with their number.
+    """
+    shard = []
+    for piece in pieces:
+        with phase('read') as record:
+            chunk = read_dataset(infile, piece=piece, dtype=dtypes)
+            record.rows = len(chunk)
+        chunk = chunk[chunk["Delay"].notnull()]
+        windows = time_window_ids(chunk["dateTime"], start)
+        chunk = chunk[(windows >= first) & (windows <= last)]
+        if not chunk.empty:
+            with phase('encode', rows=len(chunk)):
+                shard.append(encode_dataset(chunk, categories=categories)[ENCODED_COLS])
+    encoded = []
+    for batch in aggregate_shard(pd.concat(shard), start, previous):
+        with phase('serialize', rows=len(batch)):
+            encoded.append((len(batch), encode_chunk(batch, fmt, index=True, date_format=DATE_FORMAT)))
+    return encoded
+
+
+def stream_aggregate(infile: str, outfile: str, chunksize: int, jobs: int = 1, fmt: str = None):
+    """Aggregate the dataset reading it in pieces, so that it never has to be loaded at once.
+
+    The input must be a file (not stdin), as it is read twice. The first pass scans the pieces of the file (of about
+    ``chunksize`` rows) for the timestamps and the categories in each of them. Then the windows are grouped in shards
+    of about ``chunksize`` rows, and each shard is read (only from the pieces that have its rows), encoded and
+    aggregated (and serialized) by one of ``jobs`` processes: the memory used depends on the size of the shards and
+    not on the one of the input. The shards are written in order, and the output is the same as the one of
+    ``aggregate``.
+    """
+    if infile == STDIO:
+        raise ValueError("Streaming aggregation can't read from stdin")
+    scan = scan_dataset(infile, chunksize, jobs=jobs)
+    with aggregate_writer(outfile, fmt) as writer:
+        # The batches are serialized by the workers, so that the writes are all that's left to this process
+        func = partial(aggregate_pieces, infile, start=scan.start, categories=scan.categories, dtypes=scan.dtypes,
+                       fmt=writer.fmt)
+        for batches in merge_phases(ordered_map(gathered(func), plan_shards(scan, chunksize), jobs)):
+            for rows, batch in batches:
+                with phase('write', rows=rows):
+                    writer.write_encoded(batch)
+
+
+def main():
+    args = setup_args()
+    with instrumented('aggregate', args.metrics, args.profile):
+        if args.chunksize or args.jobs > 1:
+            stream_aggregate(args.infile, args.output, args.chunksize or DEFAULT_CHUNKSIZE, jobs=args.jobs,
+                             fmt=args.format)
+        else:
+            aggregate(args.infile, args.output, fmt=args.format)
 
 
 if __name__ == '__main__':
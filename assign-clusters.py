@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Assign the rows of a dataset (or the positions sent over HTTP) to the
+# clusters, using only the centroids written by `clustering.py --centroids`.
+# As a filter it reads the rows from stdin as they arrive and writes them,
+# with their clusters, to stdout a batch at a time: a batch is written when it
+# has --chunksize rows or its first row has waited --latency seconds, so a
+# slow stream of positions isn't held back. With --serve it answers to
+#   GET /?lon=10.75&lat=59.91[&lon=...&lat=...]
+#   POST / with a JSON list of [longitude, latitude] pairs
+# with the JSON {"clusters": [...], "centroids": [[longitude, latitude], ...]}.
+
+import argparse
+import io
+import json
+import logging
+import os
+import select
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Iterator, List
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from centroids import COORDINATES, DEFAULT_CACHE_SIZE, ClusterAssigner, attach_clusters
+from tableio import STDIO, TableWriter, add_format_argument, read_chunks
+from transports import DTYPES
+
+
+def setup_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('centroids', help="Centroids written by clustering.py (.npy)")
+    parser.add_argument('infile', nargs='?', default=STDIO, help="Input file. Defaults to stdin")
+    parser.add_argument('--output', '-o', default=STDIO, help="Output file. Defaults to stdout (only for CSV)")
+    add_format_argument(parser)
+    parser.add_argument('--chunksize', '-c', type=int, default=10_000,
+                        help="Number of rows read (and written) at a time. Use 1 for a stream of single positions")
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help="Most seconds a row read from stdin waits for the rest of its chunk")
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help="Number of distinct coordinates whose cluster is remembered")
+    parser.add_argument('--serve', type=int, metavar='PORT', help="Answer to HTTP requests on PORT instead")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to serve on")
+    return parser.parse_args()
+
+
+def parse_lines(header: bytes, lines: List[bytes]) -> pd.DataFrame:
+    return pd.read_csv(io.BytesIO(b'\n'.join([header, *lines])), dtype=DTYPES)
+
+
+def stdin_chunks(chunksize: int, latency: float = 0.1) -> Iterator[pd.DataFrame]:
+    """Yield the rows of the CSV read from stdin as soon as there are ``chunksize`` of them, or the first of them has
+    waited ``latency`` seconds.
+
+    The lines are read as they arrive (not in blocks, as a buffered reader would wait to fill them).
+    """
+    fd = sys.stdin.fileno()
+    header = None
+    lines = []
+    pending = b''
+    deadline = None
+    while True:
+        timeout = max(deadline - time.monotonic(), 0) if lines else None
+        ready, _, _ = select.select([fd], [], [], timeout)
+        if ready:
+            data = os.read(fd, 64 * 1024)
+            if not data:
+                break
+            *complete, pending = (pending + data).split(b'\n')
+            for line in complete:
+                if header is None:
+                    header = line
+                    continue
+                if not lines:
+                    deadline = time.monotonic() + latency
+                lines.append(line)
+        if lines and (len(lines) >= chunksize or time.monotonic() >= deadline):
+            yield parse_lines(header, lines)
+            lines = []
+    if pending.strip():
+        lines.append(pending)
+    if lines:
+        yield parse_lines(header, lines)
+
+
+def assign_file(infile: str, outfile: str, assigner: ClusterAssigner, chunksize: int = 10_000, fmt: str = None,
+                latency: float = 0.1):
+    chunks = stdin_chunks(chunksize, latency) if str(infile) == STDIO else read_chunks(infile, chunksize, dtype=DTYPES)
+    with TableWriter(outfile, fmt=fmt) as writer:
+        for df in chunks:
+            writer.write(attach_clusters(df, assigner.assign(df[COORDINATES].to_numpy()), assigner.centers))
+            if str(outfile) == STDIO:
+                sys.stdout.flush()
+
+
+class AssignHandler(BaseHTTPRequestHandler):
+    assigner: ClusterAssigner = None
+
+    def _answer(self, coordinates: np.ndarray):
+        labels = self.assigner.assign(coordinates)
+        body = json.dumps({'clusters': labels.tolist(), 'centroids': self.assigner.centers[labels].tolist()})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def _coordinates(self, pairs) -> np.ndarray:
+        coordinates = np.array(pairs, dtype=np.float64)
+        if coordinates.ndim != 2 or coordinates.shape[1] != len(COORDINATES):
+            raise ValueError("Expected a list of [longitude, latitude] pairs")
+        return coordinates
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        try:
+            self._answer(self._coordinates(list(zip(query.get('lon', []), query.get('lat', [])))))
+        except ValueError as e:
+            self.send_error(400, str(e))
+
+    def do_POST(self):
+        try:
+            pairs = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            self._answer(self._coordinates(pairs))
+        except ValueError as e:
+            self.send_error(400, str(e))
+
+
+def serve(assigner: ClusterAssigner, port: int, host: str = '127.0.0.1'):
+    AssignHandler.assigner = assigner
+    with HTTPServer((host, port), AssignHandler) as server:
+        logging.info("Serving on %s:%d", host, port)
+        server.serve_forever()
+
+
+def main():
+    args = setup_args()
+    logging.basicConfig(level=logging.INFO)
+    assigner = ClusterAssigner.load(args.centroids, cache_size=args.cache_size)
+    if args.serve is not None:
+        serve(assigner, args.serve, args.host)
+    else:
+        assign_file(args.infile, args.output, assigner, chunksize=args.chunksize, fmt=args.format,
+                    latency=args.latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Check that `aggregate.grouped_diff` gives the same results as the per-group diff and concat it replaced.
+
+Unlike `grouped_diff.py`, which times both on a large frame, this runs on a few small ones in a couple of seconds:
+contiguous and interleaved groups, groups of a single row and missing values, each with a shuffled index. It exits with
+an error at the first case that differs.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+from typing import Iterator, Tuple
+
+import numpy as np
+import pandas as pd
+
+from grouped_diff import legacy_grouped_diff
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from aggregate import grouped_diff  # noqa: E402
+
+COLUMNS = ['OriginAimedDepartureTime', 'DestinationAimedArrivalTime']
+
+
+def setup_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', '-n', default=2_000, type=int, help="Rows of the random cases")
+    parser.add_argument('--seed', '-s', default=42, type=int)
+    return parser.parse_args()
+
+
+def frame(values: np.ndarray, keys: np.ndarray, rng: np.random.Generator) -> Tuple[pd.DataFrame, pd.Series]:
+    """A frame of the aimed times with ``values``, grouped by ``keys``, with a shuffled index as in aggregate.py."""
+    index = rng.permutation(len(keys))
+    return pd.DataFrame(values, index=index, columns=COLUMNS), pd.Series(keys, index=index)
+
+
+def cases(rows: int, rng: np.random.Generator) -> Iterator[Tuple[str, pd.DataFrame, pd.Series]]:
+    values = rng.integers(1_640_000_000, 1_650_000_000, (rows, len(COLUMNS))).astype('float64')
+    missing = values.copy()
+    missing[rng.random(missing.shape) < 0.1] = np.nan
+    contiguous = np.sort(rng.integers(0, rows // 20, rows))
+    interleaved = rng.permutation(contiguous)
+    # Most groups have a single row
+    singles = np.sort(np.concatenate([np.arange(rows - rows // 10), rng.integers(0, rows, rows // 10)]))
+
+    yield ('hand-written', *frame(np.array([[1, 10], [3, 30], [6, 60], [2, 20], [5, 50], [9, 90]], dtype='float64'),
+                                  np.array([0, 0, 0, 1, 1, 2]), rng))
+    yield 'contiguous', *frame(values, contiguous, rng)
+    yield 'interleaved', *frame(values, interleaved, rng)
+    yield 'single-row groups', *frame(values, singles, rng)
+    yield 'single-row groups, interleaved', *frame(values, rng.permutation(singles), rng)
+    yield 'a single group', *frame(values, np.zeros(rows, dtype=int), rng)
+    yield 'missing values, contiguous', *frame(missing, contiguous, rng)
+    yield 'missing values, interleaved', *frame(missing, interleaved, rng)
+    yield 'integer values', *frame(values.astype('int64'), interleaved, rng)
+
+
+def main():
+    args = setup_args()
+    rng = np.random.default_rng(args.seed)
+    for name, df, keys in cases(args.rows, rng):
+        pd.testing.assert_frame_equal(grouped_diff(df, keys), legacy_grouped_diff(df, keys), obj=name)
+        print(f"{name}: ok")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Check `aggregate.grouped_diff` against the per-group diff and concat it replaced, and compare their speed.
+
+Both contiguous groups (as in aggregate.py, where the rows are sorted by time) and interleaved ones are tested. For a
+quick check of the results alone, on small frames, run `check_grouped_diff.py`.
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from aggregate import grouped_diff  # noqa: E402
+
+
+def setup_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', '-n', default=1_000_000, type=int)
+    parser.add_argument('--groups', '-g', default=20_000, type=int)
+    parser.add_argument('--seed', '-s', default=42, type=int)
+    return parser.parse_args()
+
+
+def legacy_grouped_diff(df: pd.DataFrame, keys: pd.Series) -> pd.DataFrame:
+    return pd.concat(group.diff().fillna(0) for _, group in df.groupby(keys)).reindex(df.index)
+
+
+def main():
+    args = setup_args()
+    rng = np.random.default_rng(args.seed)
+    df = pd.DataFrame({
+        'OriginAimedDepartureTime': rng.integers(1_640_000_000, 1_650_000_000, args.rows),
+        'DestinationAimedArrivalTime': rng.integers(1_640_000_000, 1_650_000_000, args.rows),
+    }, index=rng.permutation(args.rows))
+    keys = pd.Series(np.sort(rng.integers(0, args.groups, args.rows)), index=df.index)
+    print("layout,implementation,rows,seconds")
+    interleaved = keys.sample(frac=1, random_state=args.seed).set_axis(df.index)
+    for layout, k in [('contiguous', keys), ('interleaved', interleaved)]:
+        start = time.perf_counter()
+        expected = legacy_grouped_diff(df, k)
+        print(f"{layout},legacy,{len(df)},{time.perf_counter() - start:.3f}")
+        start = time.perf_counter()
+        result = grouped_diff(df, k)
+        print(f"{layout},grouped_diff,{len(df)},{time.perf_counter() - start:.3f}")
+        pd.testing.assert_frame_equal(result, expected)
+
+
+if __name__ == '__main__':
+    main()
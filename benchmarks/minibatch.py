@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Compare the quality (inertia and silhouette) and the speed of the streamed MiniBatchKMeans of `clustering.py
+--mode minibatch` with the KMeans fitted on all the rows.
+
+The silhouette is computed on a sample of the rows, the inertia on all of them.
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from sklearn.cluster import KMeans
+from sklearn.metrics import silhouette_score
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from clustering import coordinate_chunks, fit_minibatch  # noqa: E402
+
+
+def setup_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('infile', nargs='+')
+    parser.add_argument('--clusters', '-k', default=100, type=int)
+    parser.add_argument('--seed', '-s', default=42, type=int)
+    parser.add_argument('--chunksize', '-c', default=100_000, type=int)
+    parser.add_argument('--epochs', '-e', default=[1, 3], type=int, nargs='+')
+    parser.add_argument('--sample', default=20_000, type=int, help="Rows used for the silhouette")
+    return parser.parse_args()
+
+
+def inertia(coordinates: np.ndarray, clusterer) -> float:
+    return float(-clusterer.score(coordinates))
+
+
+def main():
+    args = setup_args()
+    coordinates = np.concatenate(list(coordinate_chunks(args.infile, args.chunksize)))
+    sample = np.random.default_rng(args.seed).choice(len(coordinates), min(args.sample, len(coordinates)),
+                                                    replace=False)
+    print("model,epochs,rows,seconds,inertia,silhouette")
+    start = time.perf_counter()
+    full = KMeans(n_clusters=args.clusters, random_state=args.seed, n_init=10).fit(coordinates)
+    seconds = time.perf_counter() - start
+    silhouette = silhouette_score(coordinates[sample], full.predict(coordinates[sample]))
+    print(f"kmeans,,{len(coordinates)},{seconds:.3f},{inertia(coordinates, full):.6g},{silhouette:.4f}")
+    for epochs in args.epochs:
+        start = time.perf_counter()
+        streamed = fit_minibatch(args.infile, args.clusters, args.seed, chunksize=args.chunksize, epochs=epochs)
+        seconds = time.perf_counter() - start
+        silhouette = silhouette_score(coordinates[sample], streamed.predict(coordinates[sample]))
+        print(f"minibatch,{epochs},{len(coordinates)},{seconds:.3f},{inertia(coordinates, streamed):.6g},"
+              f"{silhouette:.4f}")
+
+
+if __name__ == '__main__':
+    main()
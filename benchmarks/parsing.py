@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Compare the throughput of the per-row parsers used before `transports` with the vectorized ones.
+
+The per-row parsers are far too slow for the full synthetic frame, so they run on its first --legacy-rows rows
+(their results are also checked against the vectorized ones on those rows).
+"""
+
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from transports import floor_window, parse_delay, parse_local_time  # noqa: E402
+
+
+def setup_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', '-n', default=10_000_000, type=int, help="Rows of the synthetic frame")
+    parser.add_argument('--legacy-rows', '-l', default=100_000, type=int,
+                        help="Rows on which the per-row parsers are timed")
+    parser.add_argument('--cardinality', '-c', default=200_000, type=int,
+                        help="Distinct aimed times in the synthetic frame")
+    parser.add_argument('--seed', '-s', default=42, type=int)
+    return parser.parse_args()
+
+
+def synthetic_frame(rows: int, cardinality: int, seed: int = 42) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2022-03-01T18:40:00")
+    delays = np.arange(-600, 3600)
+    delays = pd.Series(np.where(delays < 0, '-', '').astype(object) + 'PT' + np.abs(delays).astype(str) + 'S')
+    aimed = (start + pd.to_timedelta(rng.integers(0, 7 * 24 * 3600, cardinality), unit='s'))
+    aimed = pd.Series(aimed.strftime('%Y-%m-%dT%H:%M:%S').astype(object) + '+01:00')
+    return pd.DataFrame({
+        'dateTime': start + pd.to_timedelta(np.sort(rng.integers(0, 7 * 24 * 3600, rows)), unit='s'),
+        'Delay': delays.take(rng.integers(0, len(delays), rows)).to_numpy(),
+        'OriginAimedDepartureTime': aimed.take(rng.integers(0, cardinality, rows)).to_numpy(),
+    })
+
+
+def legacy_delay(col: pd.Series) -> pd.Series:
+    return col.map(lambda x: int(re.sub(r"(-?)PT(\d+)S", r"\1\2", x)))
+
+
+def legacy_local_time(col: pd.Series) -> pd.Series:
+    # read_csv(parse_dates=...) followed by the tz_localize(None) map
+    return pd.to_datetime(col).map(lambda x: x.tz_localize(None))
+
+
+def legacy_floor_window(col: pd.Series) -> pd.Series:
+    return col.map(lambda x: x.floor(freq='5T'))
+
+
+def measure(func: Callable[[pd.Series], pd.Series], col: pd.Series):
+    start = time.perf_counter()
+    result = func(col)
+    return result, time.perf_counter() - start
+
+
+def main():
+    args = setup_args()
+    df = synthetic_frame(args.rows, args.cardinality, seed=args.seed)
+    benchmarks = [
+        ('Delay', legacy_delay, parse_delay),
+        ('OriginAimedDepartureTime', legacy_local_time, parse_local_time),
+        ('dateTime', legacy_floor_window, floor_window),
+    ]
+    print("column,implementation,rows,seconds,rows_per_second")
+    for col, legacy, vectorized in benchmarks:
+        sample = df[col].head(args.legacy_rows)
+        expected, elapsed = measure(legacy, sample)
+        print(f"{col},legacy,{len(sample)},{elapsed:.3f},{len(sample) / elapsed:.0f}")
+        result, elapsed = measure(vectorized, df[col])
+        print(f"{col},vectorized,{len(df)},{elapsed:.3f},{len(df) / elapsed:.0f}")
+        if not result.head(args.legacy_rows).equals(expected):
+            raise AssertionError(f"The parsers of {col} disagree")
+
+
+if __name__ == '__main__':
+    main()
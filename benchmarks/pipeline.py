@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Time the stages of the pipeline, and measure their peak memory, on synthetic feeds (see `synthetic.py`) of
+several sizes.
+
+Each stage runs its script as `dvc.yaml` does, from the root of the repository (so with the parameters of
+`params.yaml`), in a process of its own: its peak memory is the one of the biggest among that process and the
+processes it started, each taken alone (not their sum, so a stage running several workers uses more than that).
+The results are written as a JSON report and compared with a baseline, a report of an earlier run (by default the
+one in `baseline.json`, measured with `--rows 10000` on the tree it was committed with): the stages that got slower
+or bigger than the tolerance allows are reported as regressions, and make the benchmark fail.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import yaml
+
+from synthetic import add_cardinality_arguments, cardinalities, synthetic_feed, write_feed, write_results
+
+ROOT = Path(__file__).absolute().parent.parent
+BASELINE = Path(__file__).absolute().parent / 'baseline.json'
+STAGES = ['cleaning', 'clustering', 'aggregate', 'time-windows', 'create-train-test', 'resizing',
+          'create-train-test-v2', 'process-results']
+PACKAGES = ['numpy', 'pandas', 'pyarrow', 'scikit-learn', 'scipy', 'p_tqdm']
+
+
+def setup_args() -> argparse.Namespace:
+    with open(ROOT / "params.yaml", "r") as f:
+        params = yaml.safe_load(f)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', '-n', default=[10_000, 100_000], type=int, nargs='+',
+                        help="Rows of the synthetic feeds, one run of the pipeline for each")
+    parser.add_argument('--stages', default=STAGES, choices=STAGES, nargs='+',
+                        help="Stages to measure (the ones before them run anyway, to produce their inputs)")
+    parser.add_argument('--files', default=4, type=int, help="Number of files of each feed")
+    parser.add_argument('--hours', default=24, type=int, help="Hours covered by each feed (one split each)")
+    add_cardinality_arguments(parser)
+    parser.add_argument('--clusters', '-k', default=params['clustering']['k'], type=int)
+    parser.add_argument('--repeat', default=1, type=int, help="Runs of each stage, of which the fastest is kept")
+    parser.add_argument('--seed', '-s', default=params['seed'], type=int)
+    parser.add_argument('--report', '-r', default='benchmark.json', help="Output JSON report")
+    parser.add_argument('--baseline', '-b', default=str(BASELINE) if BASELINE.exists() else None,
+                        help="Report of an earlier run to compare with")
+    parser.add_argument('--tolerance', '-t', default=0.25, type=float,
+                        help="Fraction by which a stage can be slower or bigger than the baseline")
+    parser.add_argument('--min-seconds', default=0.5, type=float,
+                        help="Slowdowns shorter than this are never regressions (they are noise)")
+    parser.add_argument('--workdir', '-w', default=None,
+                        help="Where the feeds and the outputs of the stages are kept. Defaults to a temporary one")
+    return parser.parse_args()
+
+
+def stage_command(stage: str, work: Path, clusters: int) -> Tuple[List[str], Path]:
+    """Return the arguments of the script of ``stage``, with its inputs and outputs in ``work``, and its output."""
+    def at(name: str) -> str:
+        return str(work / name)
+
+    feed = [str(path) for path in sorted((work / 'transports').glob('*.csv'))]
+    commands = {
+        'cleaning': (['cleaning.py', *feed, '-o', at('cleaned.csv')], 'cleaned.csv'),
+        'clustering': (['clustering.py', '-f', '-k', str(clusters), '-m', at('clusterer.pkl'), '--centroids',
+                        at('centroids.npy'), '-o', at('clustered.csv'), at('cleaned.csv')], 'clustered.csv'),
+        'aggregate': (['aggregate.py', '--chunksize', '100000', at('clustered.csv'), '-o', at('aggregates.csv')],
+                      'aggregates.csv'),
+        'time-windows': (['time-windows.py', at('aggregates.csv'), '-o', at('windows')], 'windows'),
+        'create-train-test': (['create-train-test.py', at('windows'), at('train-test')], 'train-test'),
+        'resizing': (['resize-train-test.py', at('train-test'), at('resized-train-test')], 'resized-train-test'),
+        'create-train-test-v2': (['create-train-test-v2.py', at('windows'), at('train-test-v2')], 'train-test-v2'),
+        'process-results': (['process-results.py', at('results'), '--store', at('results-store')], 'results-store'),
+    }
+    args, output = commands[stage]
+    # The scripts run from the root of the repository
+    return [str(ROOT / args[0]), *args[1:]], work / output
+
+
+def disk_usage(path: Path) -> int:
+    if path.is_dir():
+        return sum(file.stat().st_size for file in path.rglob('*') if file.is_file())
+    return path.stat().st_size if path.exists() else 0
+
+
+def run(args: List[str], log: Path) -> Tuple[float, float]:
+    """Run the script with ``args`` and return the seconds it took and its peak memory (in MiB), the one of the
+    biggest among its process and the processes it started."""
+    with open(log, 'wb') as f:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, *args], cwd=ROOT, stdout=subprocess.DEVNULL, stderr=f)
+        # Unlike Popen.wait, wait4 also returns the resources used by the process: its ru_maxrss is the peak of the
+        # biggest among it and the children it waited for, not of all of them together
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"{Path(args[0]).name} failed with status {process.returncode}, see {log}")
+    # ru_maxrss is in KiB on Linux
+    return seconds, usage.ru_maxrss / 1024
+
+
+def benchmark_pipeline(work: Path, rows: int, stages: List[str], files: int = 4, hours: int = 24, clusters: int = 100,
+                       repeat: int = 1, seed: int = 42, feed: dict = None) -> List[dict]:
+    """Run the pipeline on a synthetic feed of ``rows`` rows (with the cardinalities in ``feed``), and return the
+    measures of ``stages``."""
+    write_feed(synthetic_feed(rows, seed=seed, hours=hours, **(feed or {})), work / 'transports', files=files)
+    results = []
+    for stage in STAGES[:max(STAGES.index(stage) for stage in stages) + 1]:
+        if stage == 'process-results':
+            splits = len(list((work / 'train-test').glob('split-*')))
+            write_results(work / 'results', splits, rows // hours, seed=seed)
+        args, output = stage_command(stage, work, clusters)
+        runs = [run(args, work / f"{stage}.log") for _ in range(repeat if stage in stages else 1)]
+        if stage in stages:
+            seconds, max_rss = min(runs)[0], max(rss for _, rss in runs)
+            results.append({'stage': stage, 'rows': rows, 'seconds': round(seconds, 3),
+                            'max_rss_mb': round(max_rss, 1), 'rows_per_second': round(rows / seconds),
+                            'output_bytes': disk_usage(output)})
+    return results
+
+
+def environment() -> Dict[str, str]:
+    packages = {}
+    for package in PACKAGES:
+        try:
+            packages[package] = version(package)
+        except PackageNotFoundError:
+            packages[package] = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'packages': packages}
+
+
+def compare(results: List[dict], baseline: List[dict], tolerance: float = 0.25, min_seconds: float = 0.5):
+    """Add to each of ``results`` its measures in the ``baseline`` and whether it regressed."""
+    previous = {(result['stage'], result['rows']): result for result in baseline}
+    for result in results:
+        base = previous.get((result['stage'], result['rows']))
+        if base is None:
+            result['status'] = 'new'
+            continue
+        result['baseline_seconds'], result['baseline_max_rss_mb'] = base['seconds'], base['max_rss_mb']
+        slower = (result['seconds'] > base['seconds'] * (1 + tolerance)
+                  and result['seconds'] - base['seconds'] > min_seconds)
+        bigger = result['max_rss_mb'] > base['max_rss_mb'] * (1 + tolerance)
+        result['status'] = 'regression' if slower or bigger else 'ok'
+
+
+def main():
+    args = setup_args()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix='benchmark-'))
+    results = []
+    try:
+        for rows in args.rows:
+            work = workdir / str(rows)
+            shutil.rmtree(work, ignore_errors=True)
+            work.mkdir(parents=True)
+            results.extend(benchmark_pipeline(work, rows, args.stages, files=args.files, hours=args.hours,
+                                              clusters=args.clusters, repeat=args.repeat, seed=args.seed,
+                                              feed=cardinalities(args)))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if baseline is not None:
+        compare(results, baseline['results'], tolerance=args.tolerance, min_seconds=args.min_seconds)
+
+    report = {'environment': environment(),
+              'parameters': {'files': args.files, 'hours': args.hours, 'clusters': args.clusters,
+                             'repeat': args.repeat, 'seed': args.seed, **cardinalities(args)},
+              'results': results}
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print("stage,rows,seconds,max_rss_mb,rows_per_second,baseline_seconds,baseline_max_rss_mb,status")
+    for result in results:
+        print(f"{result['stage']},{result['rows']},{result['seconds']:.3f},{result['max_rss_mb']:.1f},"
+              f"{result['rows_per_second']},{result.get('baseline_seconds', '')},"
+              f"{result.get('baseline_max_rss_mb', '')},{result.get('status', '')}")
+    if any(result.get('status') == 'regression' for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
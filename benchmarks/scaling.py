@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Measure how the streaming aggregation of `aggregate.py` scales with `--jobs`, on a clustered dataset.
+
+Each number of jobs is timed in a process of its own. Besides the speedup over a single job, the run with a single
+job gives the share of the time spent in the main process (merging the scan, planning the shards and writing the
+output), which the workers can't take over: the speedup that Amdahl's law allows with that share is printed next to
+the measured one.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+from pathlib import Path
+
+from pipeline import ROOT, run
+
+# The phases of aggregate.py run by the workers
+WORKER_PHASES = ['scan-piece', 'read', 'encode', 'window', 'group', 'count', 'widen', 'serialize']
+
+
+def setup_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('infile', help="Clustered dataset (the output of clustering.py)")
+    parser.add_argument('--jobs', '-j', default=[1, 2, 4, 8], type=int, nargs='+')
+    parser.add_argument('--chunksize', '-c', default=100_000, type=int)
+    parser.add_argument('--repeat', default=1, type=int,
+                        help="Runs of each number of jobs, of which the fastest is kept")
+    return parser.parse_args()
+
+
+def serial_share(metrics: dict) -> float:
+    """The share of the time of a run with a single job that isn't spent in the phases of the workers."""
+    parallel = sum(metrics['phases'].get(name, {}).get('seconds', 0) for name in WORKER_PHASES)
+    return max(metrics['seconds'] - parallel, 0) / metrics['seconds']
+
+
+def main():
+    args = setup_args()
+    jobs = sorted(set(args.jobs) | {1})
+    with tempfile.TemporaryDirectory(prefix='scaling-') as work:
+        work = Path(work)
+        seconds = {}
+        for n in jobs:
+            command = [str(ROOT / 'aggregate.py'), str(Path(args.infile).absolute()), '-o',
+                       str(work / 'aggregates.csv'), '-c', str(args.chunksize), '-j', str(n), '--metrics',
+                       str(work / f'metrics-{n}.json')]
+            seconds[n] = min(run(command, work / 'aggregate.log')[0] for _ in range(args.repeat))
+        with open(work / 'metrics-1.json', 'r') as f:
+            share = serial_share(json.load(f))
+
+    print(f"# {os.cpu_count()} CPUs, {share:.1%} of the time with a single job in the main process")
+    print("jobs,seconds,speedup,efficiency,amdahl_speedup")
+    for n in jobs:
+        speedup = seconds[1] / seconds[n]
+        print(f"{n},{seconds[n]:.3f},{speedup:.2f},{speedup / n:.2f},{1 / (share + (1 - share) / n):.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Generate synthetic raw feeds of the Oslo transports, with the schema of the files in `data/transports`, to run the
+pipeline without the real data.
+
+The feed is deterministic for a given seed. The vehicles run trips (a line, a direction, an origin and a destination
+stop and their aimed times) and report their position around the stops of the network: exactly at the stop when they
+are at it, a bit off otherwise. A few stop names have the encoding errors fixed by `cleaning.py`, and a few positions
+are the 0, 0 of a failed GPS fix. The same generator writes the results of SparkGHSOM on the splits, for
+`process-results.py`.
+"""
+
+import argparse
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+START = pd.Timestamp("2022-03-01T18:40:00")
+UTC_OFFSET = "+01:00"
+# Around the center of Oslo, in degrees
+CENTER = (10.75, 59.91)
+SPREAD = (0.12, 0.05)
+PLACES = ["Jernbanetorget", "Storo", "Majorstuen", "Tøyen", "Bjørvika", "Årvoll", "Skøyen", "Økern", "Ås"]
+
+
+def setup_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', help="Output directory of the feed files")
+    parser.add_argument('--rows', '-n', default=100_000, type=int, help="Rows of the feed")
+    parser.add_argument('--files', default=4, type=int, help="Number of files the rows are split in, by time")
+    parser.add_argument('--hours', default=24, type=int, help="Hours covered by the feed")
+    add_cardinality_arguments(parser)
+    parser.add_argument('--seed', '-s', default=42, type=int)
+    return parser.parse_args()
+
+
+def add_cardinality_arguments(parser: argparse.ArgumentParser):
+    # Every stop, and every line and direction, becomes a column of the aggregated windows
+    parser.add_argument('--vehicles', default=500, type=int, help="Distinct vehicles")
+    parser.add_argument('--lines', default=50, type=int, help="Distinct lines")
+    parser.add_argument('--stops', default=500, type=int, help="Distinct stops")
+    parser.add_argument('--trips', default=5_000, type=int, help="Distinct trips (and aimed times)")
+
+
+def cardinalities(args: argparse.Namespace) -> dict:
+    return {'vehicles': args.vehicles, 'lines': args.lines, 'stops': args.stops, 'trips': args.trips}
+
+
+def mojibake(names: pd.Series) -> pd.Series:
+    """Double encode the Ø and Å of ``names``, as in the feed: their UTF-8 bytes decoded as Latin-1 (e.g. Ø becomes
+    Ã\\x98), to be encoded to UTF-8 again when written."""
+    return names.str.replace('Ø', 'Ø'.encode().decode('latin-1')).str.replace('Å', 'Å'.encode().decode('latin-1'))
+
+
+def local_times(seconds: np.ndarray) -> pd.Series:
+    """Format seconds after START as ISO 8601 timestamps with the UTC offset of Oslo."""
+    times = START + pd.to_timedelta(seconds, unit='s')
+    return pd.Series(times.strftime('%Y-%m-%dT%H:%M:%S'), dtype=object) + UTC_OFFSET
+
+
+def delays(seconds: np.ndarray) -> np.ndarray:
+    """Format seconds as ISO 8601 durations (e.g. ``-PT123S``)."""
+    signs = np.where(seconds < 0, '-', '').astype(object)
+    return signs + 'PT' + np.abs(seconds).astype(str).astype(object) + 'S'
+
+
+def booleans(values: np.ndarray) -> np.ndarray:
+    return np.where(values, 'True', 'False')
+
+
+def synthetic_feed(rows: int, seed: int = 42, hours: int = 24, vehicles: int = 500, lines: int = 50,
+                   stops: int = 500, trips: int = 5_000, broken: float = 0.05, failed: float = 0.001
+                   ) -> pd.DataFrame:
+    """Return ``rows`` rows of a raw feed, sorted by time, as the text the CSV files contain.
+
+    ``broken`` is the fraction of stops whose names have encoding errors, ``failed`` the fraction of positions at 0, 0.
+    """
+    rng = np.random.default_rng(seed)
+    span = hours * 3600
+
+    # The network: the stops, with their names and positions
+    stop_names = pd.Series([f"{PLACES[i % len(PLACES)]} {i}" for i in range(stops)])
+    stop_names = stop_names.where(rng.random(stops) >= broken, mojibake(stop_names))
+    stop_refs = pd.Series([f"NSR:Quay:{i}" for i in range(stops)])
+    stop_positions = np.column_stack([rng.normal(CENTER[0], SPREAD[0], stops), rng.normal(CENTER[1], SPREAD[1], stops)])
+
+    # The trips: who runs them, where and when they are meant to
+    trip_vehicles = rng.integers(0, vehicles, trips)
+    trip_lines = rng.integers(1, lines + 1, trips)
+    trip_directions = rng.integers(1, 3, trips)
+    trip_origins = rng.integers(0, stops, trips)
+    trip_destinations = rng.integers(0, stops, trips)
+    trip_departures = rng.integers(-3600, span, trips)
+    trip_arrivals = trip_departures + rng.integers(10 * 60, 90 * 60, trips)
+
+    # The reports of the vehicles
+    trip = rng.integers(0, trips, rows)
+    stop = rng.integers(0, stops, rows)
+    at_stop = rng.random(rows) < 0.3
+    positions = stop_positions[stop] + np.where(at_stop[:, None], 0, rng.normal(0, 0.002, (rows, 2)))
+    positions[rng.random(rows) < failed] = 0
+    date_times = START + pd.to_timedelta(np.sort(rng.integers(0, span, rows)), unit='s')
+    origin, destination = trip_origins[trip], trip_destinations[trip]
+    return pd.DataFrame({
+        'dateTime': date_times.strftime('%Y-%m-%d %H:%M:%S'),
+        'LinkDistance': rng.integers(100, 5_000, rows),
+        'Percentage': np.round(rng.uniform(0, 100, rows), 2),
+        'LineRef': pd.Series(trip_lines[trip]).map("RUT:Line:{}".format).to_numpy(),
+        'DirectionRef': trip_directions[trip],
+        'PublishedLineName': trip_lines[trip],
+        'OriginRef': stop_refs.take(origin).to_numpy(),
+        'OriginName': stop_names.take(origin).to_numpy(),
+        'DestinationRef': stop_refs.take(destination).to_numpy(),
+        'DestinationName': stop_names.take(destination).to_numpy(),
+        'OriginAimedDepartureTime': local_times(trip_departures).take(trip).to_numpy(),
+        'DestinationAimedArrivalTime': local_times(trip_arrivals).take(trip).to_numpy(),
+        'VehicleRef': trip_vehicles[trip].astype(np.float64),
+        'Delay': delays(np.clip(rng.normal(60, 240, rows).astype(np.int64), -600, 3600)),
+        'HeadwayService': booleans(rng.random(rows) < 0.01),
+        'InCongestion': booleans(rng.random(rows) < 0.05),
+        'InPanic': booleans(np.zeros(rows, dtype=bool)),
+        'Longitude': positions[:, 0],
+        'Latitude': positions[:, 1],
+        'monitoredCall/StopPointRef': stop_refs.take(stop).to_numpy(),
+        'monitoredCall/VisitNumber': rng.integers(1, 40, rows).astype(np.float64),
+        'monitoredCall/StopPointName': stop_names.take(stop).to_numpy(),
+        'monitoredCall/VehicleAtStop': booleans(at_stop),
+        'monitoredCall/DestinationDisplay': stop_names.take(destination).to_numpy(),
+    })
+
+
+def write_feed(df: pd.DataFrame, output: Path, files: int = 1) -> Iterable[Path]:
+    """Write ``df`` in ``files`` CSV files of consecutive rows (as the feed was collected), and return their paths."""
+    output.mkdir(parents=True, exist_ok=True)
+    bounds = np.linspace(0, len(df), files + 1).astype(int)
+    paths = []
+    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        path = output / f"transports-{i:03d}.csv"
+        df.iloc[start:end].to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def write_results(output: Path, splits: int, rows: int, taus: Iterable[float] = (0.5, 0.7, 0.9),
+                  epochs: Iterable[int] = (50, 100), seed: int = 42) -> Iterable[Path]:
+    """Write the predictions of SparkGHSOM on ``splits`` testing sets of about ``rows`` rows, for each Tau and number
+    of epochs, in the layout read by `process-results.py`."""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for tau in taus:
+        for n in epochs:
+            for split in range(1, splits + 1):
+                size = int(rng.integers(rows // 2, rows * 3 // 2 + 1))
+                actual = rng.random(size) < 0.5
+                # Right three times out of four
+                prediction = np.where(rng.random(size) < 0.75, actual, ~actual)
+                path = output / f"tau2_0.1_tau1_{tau}_epochs_{n}datasets/oslo/split-{split}/test.csv.predictions"
+                path.parent.mkdir(parents=True, exist_ok=True)
+                pd.DataFrame({'prediction': prediction.astype(int), 'actual': actual.astype(int)}).to_csv(
+                    path, header=False, index=False)
+                paths.append(path)
+    return paths
+
+
+def main():
+    args = setup_args()
+    df = synthetic_feed(args.rows, seed=args.seed, hours=args.hours, **cardinalities(args))
+    write_feed(df, Path(args.output), files=args.files)
+
+
+if __name__ == '__main__':
+    main()
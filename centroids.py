@@ -0,0 +1,138 @@
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Assigning coordinates to their clusters with only the centroids of the clustering.
+
+The centroids are stored as a ``.npy`` array with a YAML file of metadata next to it (e.g. ``centroids.yaml`` for
+``centroids.npy``), and the nearest one to each point is found with a KD-tree over them. The vehicles report the same
+coordinates many times (e.g. at the stops), so each batch is deduplicated and the clusters of the coordinates already
+seen are cached. For the same reason the clustering can be fitted on the distinct coordinates only, each weighted by
+the number of its rows (see ``dedup_coordinates``).
+"""
+
+import logging
+from pathlib import Path
+from typing import Tuple, Union
+
+import numpy as np
+import pandas as pd
+import yaml
+from scipy.spatial import cKDTree
+
+COORDINATES = ["Longitude", "Latitude"]
+DEFAULT_CACHE_SIZE = 1_000_000
+
+
+def metadata_path(path: Union[str, Path]) -> Path:
+    return Path(path).with_suffix('.yaml')
+
+
+def save_centroids(path: Union[str, Path], centers: np.ndarray, **metadata):
+    """Write the ``centers`` (one row per cluster) to ``path``, and the ``metadata`` (e.g. the seed) next to it."""
+    centers = np.asarray(centers, dtype=np.float64)
+    np.save(path, centers)
+    with open(metadata_path(path), 'w') as f:
+        yaml.safe_dump({'clusters': len(centers), 'columns': COORDINATES, **metadata}, f)
+
+
+def load_centroids(path: Union[str, Path]) -> Tuple[np.ndarray, dict]:
+    metadata = {}
+    if metadata_path(path).exists():
+        with open(metadata_path(path), 'r') as f:
+            metadata = yaml.safe_load(f)
+    return np.load(path), metadata
+
+
+def dedup_coordinates(coordinates: np.ndarray, grid: float = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Collapse the identical rows of ``coordinates`` (after snapping them to a ``grid`` of that many degrees, if
+    given) into distinct points.
+
+    Return the points, the number of rows of each of them (to be used as ``sample_weight``) and the point of each row,
+    so that ``points[inverse]`` gives back the (snapped) coordinates.
+    """
+    coordinates = np.ascontiguousarray(coordinates, dtype=np.float64)
+    if grid:
+        coordinates = np.round(coordinates / grid) * grid
+    inverse, points = pd.factorize(coordinates.view(np.complex128).ravel())
+    points = points.view(np.float64).reshape(-1, coordinates.shape[1])
+    counts = np.bincount(inverse, minlength=len(points))
+    if len(coordinates):
+        logging.info("Deduplicated %d coordinates into %d points (%.1fx)", len(coordinates), len(points),
+                     len(coordinates) / max(len(points), 1))
+    return points, counts, inverse
+
+
+def fit_weighted(clusterer, points: pd.DataFrame, counts: np.ndarray, inverse: np.ndarray) -> np.ndarray:
+    """Fit ``clusterer`` (e.g. a ``KMeans``) on the output of ``dedup_coordinates``, and return the cluster of each
+    row."""
+    clusterer.fit(points, sample_weight=counts)
+    return clusterer.labels_[inverse]
+
+
+def fit_dedup(clusterer, coordinates: pd.DataFrame, grid: float = None) -> np.ndarray:
+    """Fit ``clusterer`` on the distinct ``coordinates`` weighted by their number of rows, and return the cluster of
+    each row."""
+    points, counts, inverse = dedup_coordinates(coordinates.to_numpy(), grid)
+    return fit_weighted(clusterer, pd.DataFrame(points, columns=coordinates.columns), counts, inverse)
+
+
+class ClusterAssigner:
+    """Find the nearest centroid (the cluster, as ``KMeans.predict`` would) of batches of coordinates.
+
+    Up to ``cache_size`` distinct coordinates are remembered, then the cache starts again from the current batch.
+    """
+
+    def __init__(self, centers: np.ndarray, cache_size: int = DEFAULT_CACHE_SIZE):
+        self.centers = np.asarray(centers, dtype=np.float64)
+        self.cache_size = cache_size
+        self._tree = cKDTree(self.centers)
+        self._cache = pd.Series([], dtype=np.intp)
+
+    @classmethod
+    def load(cls, path: Union[str, Path], cache_size: int = DEFAULT_CACHE_SIZE) -> 'ClusterAssigner':
+        return cls(load_centroids(path)[0], cache_size=cache_size)
+
+    def _query(self, coordinates: np.ndarray) -> np.ndarray:
+        return self._tree.query(coordinates)[1].astype(np.intp)
+
+    def assign(self, coordinates: np.ndarray) -> np.ndarray:
+        """Return the cluster of each row of ``coordinates`` (an array with a column per coordinate)."""
+        coordinates = np.ascontiguousarray(coordinates, dtype=np.float64)
+        if len(coordinates) == 0:
+            return np.empty(0, dtype=np.intp)
+        if np.isnan(coordinates).any():
+            raise ValueError("The coordinates can't be NaN")
+        if self.cache_size <= 0:
+            return self._query(coordinates)
+        # A pair of floats is a complex number: a single hashable key per point
+        keys = coordinates.view(np.complex128).ravel()
+        codes, uniques = pd.factorize(keys)
+        labels = self._cache.reindex(uniques).to_numpy()
+        missing = np.isnan(labels)
+        if missing.any():
+            labels[missing] = self._query(uniques[missing].view(np.float64).reshape(-1, coordinates.shape[1]))
+            new = pd.Series(labels[missing].astype(np.intp), index=uniques[missing])
+            if len(self._cache) + len(new) > self.cache_size:
+                self._cache = new
+            else:
+                self._cache = pd.concat([self._cache, new])
+        return labels.astype(np.intp)[codes]
+
+
+def attach_clusters(df: pd.DataFrame, labels: np.ndarray, centroids: np.ndarray) -> pd.DataFrame:
+    """Add to ``df`` the cluster of each row and the coordinates of its centroid."""
+    df["Cluster"] = labels
+    df[["ClusterLongitude", "ClusterLatitude"]] = centroids[labels]
+    return df
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Dataset cleaning step
+# This script receives as input multiple files and merges them and fixes any
+# errors in the characters' encoding.
+
+import argparse
+import io
+import os
+import sys
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Iterator, List, Tuple
+
+import pandas as pd
+
+from instrumentation import add_metrics_arguments, instrumented, phase, timed_chunks
+from parallel import ordered_map
+from tableio import STDIO, TableWriter, add_format_argument, byte_ranges, detect_format, read_lines
+from transports import DTYPES, apply_schema
+
+BLOCK_SIZE = 16 * 1024 * 1024
+# The characters broken by the double encoding of the feed: their UTF-8 bytes were decoded as Latin-1 and encoded
+# to UTF-8 again
+REPAIRS = [
+    (b'\xc3\x83\xc2\x85', b'\xc3\x85'),  # Å
+    (b'\xc3\x83\xc2\x98', b'\xc3\x98'),  # Ø
+]
+
+
+def setup_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('infile', nargs='+')
+    parser.add_argument('--output', '-o', default=STDIO, help="Output file. Defaults to stdout (only for CSV)")
+    add_format_argument(parser)
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count())
+    add_metrics_arguments(parser)
+    return parser.parse_args()
+
+
+def read_header(file: Path) -> bytes:
+    with open(file, 'rb') as f:
+        return f.readline()
+
+
+def repair(data: bytes) -> bytes:
+    for broken, fixed in REPAIRS:
+        data = data.replace(broken, fixed)
+    return data
+
+
+def file_blocks(file: Path, header: bytes) -> Iterator[Tuple[Path, int, int]]:
+    """Cut the rows of ``file`` (after its header) into ranges of about ``BLOCK_SIZE`` bytes."""
+    if read_header(file) != header:
+        raise ValueError(f"The header of {file} is different from the one of the first file")
+    for start, end in byte_ranges(file, BLOCK_SIZE):
+        yield file, start, end
+
+
+def clean_block(file: Path, start: int, end: int) -> bytes:
+    """Return the rows of ``file`` that start between the bytes ``start`` and ``end``, with the encoding errors fixed.
+
+    The block is made of whole lines, so that no broken character is split between two blocks.
+    """
+    return repair(read_lines(file, start, end))
+
+
+def count_lines(data: bytes) -> int:
+    return data.count(b'\n')
+
+
+def clean_block_table(file: Path, start: int, end: int, header: bytes) -> pd.DataFrame:
+    df = pd.read_csv(io.BytesIO(header + clean_block(file, start, end)), dtype=DTYPES)
+    return apply_schema(df)
+
+
+def clean(files: List[Path], output: str, fmt: str = 'csv', jobs: int = 1):
+    header = read_header(files[0])
+    # The files are cleaned a block at a time, so that only a few blocks are in memory at once
+    blocks = (block for file in files for block in file_blocks(file, header))
+    if fmt == 'csv':
+        # The rows are written as they are, without parsing them
+        with (open(output, 'wb') if output != STDIO else nullcontext(sys.stdout.buffer)) as out:
+            out.write(header)
+            for rows in timed_chunks('read', ordered_map(clean_block, blocks, jobs), rows=count_lines):
+                with phase('write', rows=count_lines(rows)):
+                    out.write(rows)
+    else:
+        tasks = ((*block, header) for block in blocks)
+        with TableWriter(output, fmt=fmt) as writer:
+            for df in timed_chunks('read', ordered_map(clean_block_table, tasks, jobs)):
+                # A block can be empty if a line is longer than it
+                if df.empty:
+                    continue
+                with phase('write', rows=len(df)):
+                    writer.write(df)
+
+
+def main():
+    args = setup_args()
+    with instrumented('cleaning', args.metrics, args.profile):
+        clean([Path(file) for file in args.infile], args.output, fmt=args.format or detect_format(args.output),
+              jobs=args.jobs)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,36 +19,154 @@ import argparse
 import logging
 import pickle
 import yaml
-import sys
-from functools import partial
 from pathlib import Path
-from typing import List
+from typing import Iterator, List, Optional, Union
 
+import numpy as np
 import pandas as pd
-from sklearn.cluster import KMeans
-
-
-def train_model(datasets: List[str], k: int, seed: int = 42, outfile: str = None, force: bool = False) -> pd.DataFrame:
-    load = partial(pd.read_csv, dtype={'HeadwayService': "boolean", "InCongestion": 'boolean', 'InPanic': 'boolean',
-                                       'monitoredCall/VehicleAtStop': 'boolean'})
-    df = pd.concat(map(load, datasets), axis=0, ignore_index=True)
-    df = df[(df != 0).any(axis=1)]  # Filter out errors
-    if Path(outfile).exists() and not force:
-        logging.info("Loading existing model")
-        with open(outfile, "rb") as f:
-            clusterer = pickle.load(f)
-        labels = clusterer.predict(df[["Longitude", "Latitude"]])
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+from centroids import COORDINATES, ClusterAssigner, attach_clusters, fit_dedup, save_centroids
+from instrumentation import add_metrics_arguments, instrumented, phase, timed_chunks
+from tableio import STDIO, Columns, TableWriter, add_format_argument, read_chunks, write_table
+from transports import BOUNDS, DTYPES, Bounds, PositionValidator
+
+MODES = ['full', 'minibatch']
+DEFAULT_CHUNKSIZE = 100_000
+Clusterer = Union[KMeans, MiniBatchKMeans]
+
+
+def load_model(outfile: str) -> Clusterer:
+    logging.info("Loading existing model")
+    with open(outfile, "rb") as f:
+        return pickle.load(f)
+
+
+def save_model(clusterer: Clusterer, outfile: str = None, centroids: str = None, seed: int = 42):
+    """Write the fitted ``clusterer`` (if ``outfile`` is given) and its centroids (if ``centroids`` is given)."""
+    if outfile:
+        with open(outfile, "wb") as f:
+            pickle.dump(clusterer, f)
+    if centroids:
+        save_centroids(centroids, clusterer.cluster_centers_, seed=seed, model=type(clusterer).__name__)
+
+
+def existing_assigner(centroids: str = None, force: bool = False) -> Optional[ClusterAssigner]:
+    """Return an assigner over the centroids written by a previous run, if any (and not ``force``)."""
+    if centroids and Path(centroids).exists() and not force:
+        logging.info("Loading existing centroids")
+        return ClusterAssigner.load(centroids)
+    return None
+
+
+def train_model(datasets: List[str], k: int, seed: int = 42, outfile: str = None, force: bool = False,
+                centroids: str = None, dedup: bool = False, grid: float = None, bounds: Bounds = None,
+                chunksize: int = DEFAULT_CHUNKSIZE) -> pd.DataFrame:
+    validate = PositionValidator(bounds)
+    chunks = list(timed_chunks('read', valid_chunks(datasets, validate, chunksize, dtype=DTYPES)))
+    validate.report()
+    if not chunks:
+        raise ValueError(f"There are no valid positions in {', '.join(datasets)}")
+    df = pd.concat(chunks, axis=0, ignore_index=True)
+    assigner = existing_assigner(centroids, force)
+    if assigner is not None:
+        with phase('assign', rows=len(df)):
+            labels = assigner.assign(df[COORDINATES].to_numpy())
+        return attach_clusters(df, labels, assigner.centers)
+    if outfile and Path(outfile).exists() and not force:
+        clusterer = load_model(outfile)
+        with phase('assign', rows=len(df)):
+            labels = clusterer.predict(df[COORDINATES])
+        save_model(clusterer, centroids=centroids, seed=seed)
     else:
         logging.info("Training new model")
         clusterer = KMeans(n_clusters=k, random_state=seed)
-        labels = clusterer.fit_predict(df[["Longitude", "Latitude"]])
-        if outfile:
-            with open(outfile, "wb") as f:
-                pickle.dump(clusterer, f)
-    centroids = clusterer.cluster_centers_
-    df["Cluster"] = labels
-    df[["ClusterLongitude", "ClusterLatitude"]] = centroids[labels]
-    return df
+        with phase('fit', rows=len(df)):
+            if dedup or grid:
+                labels = fit_dedup(clusterer, df[COORDINATES], grid)
+            else:
+                labels = clusterer.fit_predict(df[COORDINATES])
+        save_model(clusterer, outfile, centroids, seed)
+    return attach_clusters(df, labels, clusterer.cluster_centers_)
+
+
+def valid_chunks(datasets: List[str], validate: PositionValidator, chunksize: int = DEFAULT_CHUNKSIZE,
+                 columns: Columns = None, **csv_kwargs) -> Iterator[pd.DataFrame]:
+    """Yield the rows of the datasets with a valid position, a chunk at a time."""
+    for dataset in datasets:
+        for chunk in read_chunks(dataset, chunksize, columns=columns, **csv_kwargs):
+            chunk = validate(chunk)
+            if not chunk.empty:
+                yield chunk
+
+
+def coordinate_chunks(datasets: List[str], chunksize: int = DEFAULT_CHUNKSIZE,
+                      bounds: Bounds = None) -> Iterator[np.ndarray]:
+    """Yield the valid coordinates of the rows of the datasets, a chunk at a time, reading only their columns."""
+    for chunk in valid_chunks(datasets, PositionValidator(bounds), chunksize, columns=COORDINATES):
+        yield chunk[COORDINATES].to_numpy()
+
+
+def fit_minibatch(datasets: List[str], k: int, seed: int = 42, chunksize: int = DEFAULT_CHUNKSIZE,
+                  batch_size: int = 1024, epochs: int = 1, bounds: Bounds = None) -> MiniBatchKMeans:
+    """Fit a ``MiniBatchKMeans`` on the coordinates of the datasets, streamed ``epochs`` times.
+
+    The centroids are initialized on the first ``3 * batch_size`` rows (or ``k``, if more), as ``MiniBatchKMeans.fit``
+    does.
+    """
+    clusterer = MiniBatchKMeans(n_clusters=k, random_state=seed, batch_size=batch_size, n_init=3)
+    init_size = max(3 * batch_size, k)
+    pending = np.empty((0, len(COORDINATES)))
+    for _ in range(epochs):
+        for coordinates in coordinate_chunks(datasets, chunksize, bounds):
+            if not hasattr(clusterer, 'cluster_centers_'):
+                # Too few rows to initialize the centroids yet
+                pending = np.concatenate([pending, coordinates])
+                if len(pending) < init_size:
+                    continue
+                clusterer.partial_fit(pending[:init_size])
+                coordinates = pending[init_size:]
+            for start in range(0, len(coordinates), batch_size):
+                clusterer.partial_fit(coordinates[start:start + batch_size])
+    if not hasattr(clusterer, 'cluster_centers_'):
+        if not len(pending):
+            raise ValueError(f"There are no valid positions in {', '.join(datasets)}")
+        clusterer.partial_fit(pending)
+    return clusterer
+
+
+def stream_clusters(datasets: List[str], outfile: str, assigner: ClusterAssigner, chunksize: int = DEFAULT_CHUNKSIZE,
+                    fmt: str = None, bounds: Bounds = None):
+    """Write the rows of the datasets with a valid position with their clusters, a chunk at a time."""
+    validate = PositionValidator(bounds)
+    with TableWriter(outfile, fmt=fmt) as writer:
+        for df in timed_chunks('read', valid_chunks(datasets, validate, chunksize, dtype=DTYPES)):
+            with phase('assign', rows=len(df)):
+                labels = assigner.assign(df[COORDINATES].to_numpy())
+            with phase('write', rows=len(df)):
+                writer.write(attach_clusters(df, labels, assigner.centers))
+    validate.report()
+
+
+def stream_model(datasets: List[str], outfile: str, k: int, seed: int = 42, model: str = None, force: bool = False,
+                 chunksize: int = DEFAULT_CHUNKSIZE, batch_size: int = 1024, epochs: int = 1, fmt: str = None,
+                 centroids: str = None, bounds: Bounds = None):
+    """Like ``train_model``, but in two passes over the datasets (or one, if the model exists) that only hold a chunk
+    in memory: one to fit a ``MiniBatchKMeans`` and one to write the clusters of the rows."""
+    assigner = existing_assigner(centroids, force)
+    if assigner is None:
+        if model and Path(model).exists() and not force:
+            clusterer = load_model(model)
+            save_model(clusterer, centroids=centroids, seed=seed)
+        else:
+            logging.info("Training new model")
+            # Reading the rows is part of the fit, as they are streamed
+            with phase('fit'):
+                clusterer = fit_minibatch(datasets, k, seed, chunksize=chunksize, batch_size=batch_size, epochs=epochs,
+                                          bounds=bounds)
+            save_model(clusterer, model, centroids, seed)
+        assigner = ClusterAssigner(clusterer.cluster_centers_)
+    stream_clusters(datasets, outfile, assigner, chunksize=chunksize, fmt=fmt, bounds=bounds)
 
 
 def main():
@@ -59,7 +177,8 @@ def main():
         params = {
             'seed': 42,
             'clustering': {
-                'k': 100
+                'k': 100,
+                'bounds': BOUNDS,
             }
         }
     parser = argparse.ArgumentParser()
@@ -68,11 +187,40 @@ def main():
     parser.add_argument('--clusters', '-k', default=params['clustering']['k'], type=int)
     parser.add_argument('--force', '-f', action='store_true')
     parser.add_argument('--model', '-m', default=None)
+    parser.add_argument('--centroids', default=None,
+                        help="Centroids (.npy) to write, or to assign the clusters with if they already exist")
+    parser.add_argument('--output', '-o', default=STDIO, help="Output file. Defaults to stdout (only for CSV)")
+    add_format_argument(parser)
+    parser.add_argument('--dedup', '-d', action='store_true',
+                        help="Fit on the distinct coordinates, weighted by their number of rows (full mode only)")
+    parser.add_argument('--grid', '-g', type=float, default=None,
+                        help="Snap the coordinates to a grid of this many degrees before deduplicating them")
+    parser.add_argument('--mode', choices=MODES, default='full',
+                        help="Fit a KMeans on all the rows in memory (full) or a MiniBatchKMeans on chunks of them")
+    parser.add_argument('--chunksize', '-c', type=int, default=DEFAULT_CHUNKSIZE,
+                        help="Number of rows read (and validated) at a time")
+    parser.add_argument('--bounds', nargs=4, type=float, metavar=('LON_MIN', 'LON_MAX', 'LAT_MIN', 'LAT_MAX'),
+                        help="Range of the valid positions. Defaults to the one in params.yaml")
+    parser.add_argument('--batch-size', '-b', type=int, default=1024, help="Size of the mini batches")
+    parser.add_argument('--epochs', '-e', type=int, default=1, help="Number of passes over the rows to fit the model")
+    add_metrics_arguments(parser)
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
+    bounds = params['clustering'].get('bounds', BOUNDS)
+    if args.bounds:
+        bounds = {'Longitude': tuple(args.bounds[:2]), 'Latitude': tuple(args.bounds[2:])}
 
-    labels = train_model(args.infile, args.clusters, args.seed, outfile=args.model, force=args.force)
-    labels.to_csv(sys.stdout, index=False)
+    with instrumented('clustering', args.metrics, args.profile):
+        if args.mode == 'minibatch':
+            stream_model(args.infile, args.output, args.clusters, args.seed, model=args.model, force=args.force,
+                         chunksize=args.chunksize, batch_size=args.batch_size, epochs=args.epochs, fmt=args.format,
+                         centroids=args.centroids, bounds=bounds)
+            return
+        labels = train_model(args.infile, args.clusters, args.seed, outfile=args.model, force=args.force,
+                             centroids=args.centroids, dedup=args.dedup, grid=args.grid, bounds=bounds,
+                             chunksize=args.chunksize)
+        with phase('write', rows=len(labels)):
+            write_table(labels, args.output, fmt=args.format)
 
 
 if __name__ == '__main__':
@@ -15,24 +15,40 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+# Plot the share of tp, fp, tn and fn of each split, for the runs of SparkGHSOM
+# with a given Tau. The confusion matrices of all the runs are computed at once
+# from the results (a CSV or a store, see results.py) and kept in a small
+# metrics file, so that the plots of any Tau don't read the results again
+# until they change.
+
 import argparse
 import functools
 import sys
-from typing import Tuple, List
+from pathlib import Path
+from typing import Iterable, List
 
 import matplotlib
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 import yaml
 
+from results import INDEX_NAME, is_store, read_results
+
+RUN_COLS = ["Tau", "Epochs", "Split"]
+CONFUSION_COLS = ['tp', 'tn', 'fp', 'fn']
+
 
-def confusion_matrix(group: Tuple[pd.Timestamp, pd.DataFrame]) -> Tuple[int, int, int, int]:
-    _, grp = group
-    tp = grp.loc[(grp['Prediction'] == 1) & (grp['Actual'] == 1)].count()['Tau']
-    tn = grp.loc[(grp['Prediction'] == 0) & (grp['Actual'] == 0)].count()['Tau']
-    fp = grp.loc[(grp['Prediction'] == 1) & (grp['Actual'] == 0)].count()['Tau']
-    fn = grp.loc[(grp['Prediction'] == 0) & (grp['Actual'] == 1)].count()['Tau']
-    return tp, tn, fp, fn
+def confusion_matrices(df: pd.DataFrame) -> pd.DataFrame:
+    """Count the tp, tn, fp and fn of each run (Tau, Epochs and Split) of the results, all at once."""
+    keys = df.groupby(RUN_COLS, sort=True)
+    runs = keys.ngroup().to_numpy()
+    # The cell of the confusion matrix of each row: 2 * prediction + actual
+    cells = 2 * df['Prediction'].to_numpy(dtype=np.int64) + df['Actual'].to_numpy(dtype=np.int64)
+    counts = np.bincount(4 * runs + cells, minlength=4 * keys.ngroups).reshape(-1, 4)
+    index = keys.size().index
+    # Cells 0 (0, 0), 1 (0, 1), 2 (1, 0) and 3 (1, 1)
+    return pd.DataFrame(counts[:, [3, 0, 2, 1]], index=index, columns=CONFUSION_COLS)
 
 
 def split_to_datetime_label(split: int, perturbed: List[int] = None) -> str:
@@ -51,76 +67,99 @@ def get_test_data(index: pd.Index) -> pd.DataFrame:
                         data=numpy.random.randint(1, high=15, size=(len(index), 4)))
 
 
-def generate_missing_splits(indf):
-    limit = max(indf)
-    sizes = [
-            (1, 295), (2, 279), (3, 268), (4, 265),
-            (5, 327), (6, 251), (7, 188), (8, 41),
-            (9, 7), (10, 72), (11, 154), (12, 292),
-            (13, 363), (14, 365), (15, 377), (16, 320),
-            (17, 322), (18, 360), (19, 379), (20, 416),
-            (21, 403), (22, 415), (23, 448), (24, 444),
-            (25, 366), (26, 346), (27, 357), (28, 355),
-            (29, 332), (30, 308), (31, 211), (32, 45),
-            (33, 28), (34, 75), (35, 167), (36, 331),
-            (37, 457), (38, 490), (39, 491), (40, 396),
-            (41, 386), (42, 389), (43, 396), (44, 398),
-            (45, 444), (46, 429), (47, 435), (48, 443),
-            (49, 360), (50, 342), (51, 326), (52, 327),
-            (53, 315), (54, 300), (55, 220), (56, 46),
-            (57, 31), (58, 79), (59, 170), (60, 336),
-            (61, 439), (62, 471), (63, 454), (64, 408),
-            (65, 393), (66, 395), (67, 392), (68, 435),
-            (69, 440), (70, 460), (71, 443), (72, 429),
-            (73, 367), (74, 339), (75, 320), (76, 307),
-            (77, 287), (78, 290), (79, 232), (80, 161),
-            (81, 146), (82, 122), (83, 80), (84, 129),
-            (85, 196), (86, 224), (87, 259), (88, 320),
-            (89, 335), (90, 333), (91, 333), (92, 324),
-            (93, 342), (94, 343), (95, 365), (96, 378),
-            (97, 365), (98, 347), (99, 329), (100, 295),
-            (101, 292), (102, 277), (103, 218), (104, 156),
-            (105, 125), (106, 132), (107, 81), (108, 116),
-            (109, 170), (110, 198), (111, 218), (112, 243),
-            (113, 242), (114, 272), (115, 272), (116, 277),
-            (117, 273), (118, 282), (119, 277), (120, 277),
-            (121, 280), (122, 309), (123, 325), (124, 277),
-            (125, 288), (126, 266), (127, 195), (128, 44),
-            (129, 25), (130, 73), (131, 165), (132, 327),
-            (133, 429), (134, 467), (135, 473), (136, 412),
-            (137, 394), (138, 377), (139, 402), (140, 429),
-            (141, 454), (142, 459), (143, 444), (144, 455),
-            (145, 353), (146, 337), (147, 324), (148, 313),
-            (149, 306), (150, 275), (151, 204), (152, 44),
-            (153, 30), (154, 75), (155, 176), (156, 360),
-            (157, 506), (158, 512), (159, 483), (160, 437),
-            (161, 418), (162, 412), (163, 414), (164, 461),
-            (165, 501), (166, 506), (167, 497), (168, 410),
-    ]
-    sizes = set(filter(lambda x: x[0] < limit and x[0] not in indf, sizes))
-    segments = [[[0.7, 100, split, 0, 0]] * size for split, size in sizes]
-    return [e for l in segments for e in l]
-        
+# The number of rows of the testing set of each split, for the splits without results
+MISSING_SIZES = dict([
+    (1, 295), (2, 279), (3, 268), (4, 265),
+    (5, 327), (6, 251), (7, 188), (8, 41),
+    (9, 7), (10, 72), (11, 154), (12, 292),
+    (13, 363), (14, 365), (15, 377), (16, 320),
+    (17, 322), (18, 360), (19, 379), (20, 416),
+    (21, 403), (22, 415), (23, 448), (24, 444),
+    (25, 366), (26, 346), (27, 357), (28, 355),
+    (29, 332), (30, 308), (31, 211), (32, 45),
+    (33, 28), (34, 75), (35, 167), (36, 331),
+    (37, 457), (38, 490), (39, 491), (40, 396),
+    (41, 386), (42, 389), (43, 396), (44, 398),
+    (45, 444), (46, 429), (47, 435), (48, 443),
+    (49, 360), (50, 342), (51, 326), (52, 327),
+    (53, 315), (54, 300), (55, 220), (56, 46),
+    (57, 31), (58, 79), (59, 170), (60, 336),
+    (61, 439), (62, 471), (63, 454), (64, 408),
+    (65, 393), (66, 395), (67, 392), (68, 435),
+    (69, 440), (70, 460), (71, 443), (72, 429),
+    (73, 367), (74, 339), (75, 320), (76, 307),
+    (77, 287), (78, 290), (79, 232), (80, 161),
+    (81, 146), (82, 122), (83, 80), (84, 129),
+    (85, 196), (86, 224), (87, 259), (88, 320),
+    (89, 335), (90, 333), (91, 333), (92, 324),
+    (93, 342), (94, 343), (95, 365), (96, 378),
+    (97, 365), (98, 347), (99, 329), (100, 295),
+    (101, 292), (102, 277), (103, 218), (104, 156),
+    (105, 125), (106, 132), (107, 81), (108, 116),
+    (109, 170), (110, 198), (111, 218), (112, 243),
+    (113, 242), (114, 272), (115, 272), (116, 277),
+    (117, 273), (118, 282), (119, 277), (120, 277),
+    (121, 280), (122, 309), (123, 325), (124, 277),
+    (125, 288), (126, 266), (127, 195), (128, 44),
+    (129, 25), (130, 73), (131, 165), (132, 327),
+    (133, 429), (134, 467), (135, 473), (136, 412),
+    (137, 394), (138, 377), (139, 402), (140, 429),
+    (141, 454), (142, 459), (143, 444), (144, 455),
+    (145, 353), (146, 337), (147, 324), (148, 313),
+    (149, 306), (150, 275), (151, 204), (152, 44),
+    (153, 30), (154, 75), (155, 176), (156, 360),
+    (157, 506), (158, 512), (159, 483), (160, 437),
+    (161, 418), (162, 412), (163, 414), (164, 461),
+    (165, 501), (166, 506), (167, 497), (168, 410),
+])
+
+
+def load_metrics(path: str, metrics: str = None) -> pd.DataFrame:
+    """Return the confusion matrices of the results in ``path`` (a CSV, a store or "-" for stdin).
+
+    They are kept in ``metrics``, if given, and read from there as long as it is newer than the results.
+    """
+    if metrics and path != '-':
+        # The index of a store is rewritten whenever something is ingested
+        source = Path(path) / INDEX_NAME if is_store(path) else Path(path)
+        if Path(metrics).exists() and Path(metrics).stat().st_mtime >= source.stat().st_mtime:
+            return pd.read_csv(metrics, index_col=RUN_COLS)
+    df = pd.read_csv(sys.stdin) if path == '-' else read_results(path)
+    matrices = confusion_matrices(df)
+    if metrics and path != '-':
+        matrices.to_csv(metrics)
+    return matrices
+
+
+def add_missing_splits(matrices: pd.DataFrame, present: Iterable[int]) -> pd.DataFrame:
+    """Add the splits before the last one ``present`` that have no results, counting all their rows as tn."""
+    limit = max(present)
+    missing = sorted(split for split in MISSING_SIZES if split < limit and split not in set(present))
+    fill = pd.DataFrame(0, index=missing, columns=CONFUSION_COLS)
+    fill['tn'] = [MISSING_SIZES[split] for split in missing]
+    return pd.concat([matrices, fill]).groupby(level=0).sum()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('input', type=argparse.FileType('r'), default=sys.stdin)
+    parser.add_argument('input', nargs='?', default='-', help="Results (a CSV or a store). Defaults to stdin")
     parser.add_argument('--perturbed', '-p', type=argparse.FileType('r'), default=None)
+    parser.add_argument('--tau', '-t', type=float, default=0.7, help="Tau of the runs to plot")
+    parser.add_argument('--metrics', '-m', default=None,
+                        help="CSV file where the confusion matrices of all the runs are kept between plots")
     args = parser.parse_args()
 
     perturbed_splits = yaml.safe_load(args.perturbed)['perturbed-splits'] if args.perturbed else []
 
-    df = pd.read_csv(args.input)
-    df = pd.concat([df, pd.DataFrame(generate_missing_splits(df['Split'].unique()), columns=df.columns)])
-    df = df.sort_values('Split')
-    df = df.loc[df['Tau'] == 0.7]
+    matrices = load_metrics(args.input, args.metrics)
+    present = matrices.index.get_level_values('Split').unique()
+    # The runs with different epochs are counted together, split by split
+    tau = matrices.loc[np.isclose(matrices.index.get_level_values('Tau'), args.tau)]
+    new_df = add_missing_splits(tau.groupby(level='Split').sum(), present)
 
     split_to_datetime_label = functools.partial(split_to_datetime_label, perturbed=perturbed_splits)
-    df['datetime'] = df['Split'].map(split_to_datetime_label)
-
-    new_df = pd.DataFrame(index=df['datetime'].unique(),
-                          columns=['tp', 'tn', 'fp', 'fn'],
-                          data=map(confusion_matrix, df.groupby('datetime')))
+    new_df.index = new_df.index.map(split_to_datetime_label)
+    new_df = new_df.groupby(level=0, sort=False).sum()
 
     # new_df = get_test_data(new_df.index)
 
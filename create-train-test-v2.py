@@ -16,16 +16,25 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import logging
+import os
 import shutil
-from collections import namedtuple
 from functools import partial
 from pathlib import Path
-import random
 from typing import List, Tuple, Set, Union
 
+import numpy as np
 import pandas as pd
 import yaml
-from p_tqdm import p_umap
+
+from instrumentation import add_metrics_arguments, gathered, instrumented, merge_phases, phase, timed_chunks
+from parallel import TaskCost, scheduled_map
+from perturbation import perturb_rows, perturbed_splits, split_rng
+from splits import (MANIFEST_NAME, MEMORY_FACTOR, PERTURB_COST, TABLE_COST, WORKER_MEMORY, remove_splits, stale_sets,
+                    virtual_manifest)
+from tableio import EXTENSIONS, TableWriter, add_format_argument, read_table, write_table
+from windowstore import (is_store, iter_windows, list_windows, store_format, window_name, window_signatures,
+                         window_sizes)
 
 
 def setup_args() -> argparse.Namespace:
@@ -51,6 +60,15 @@ def setup_args() -> argparse.Namespace:
                         type=float,
                         help="Fraction of data to be perturbed")
     parser.add_argument('--drop', '-d', action='append')
+    add_format_argument(parser, "Format of the windows, and of the splits", default='csv')
+    parser.add_argument('--virtual', action='store_true',
+                        help="List the training windows of each split in its manifest instead of copying them")
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help="Only create the splits (or their sets) that changed since the last run")
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count())
+    parser.add_argument('--writers', type=int, default=None,
+                        help="Most splits with large sets written at once (e.g. on a slow disk). Defaults to --jobs")
+    add_metrics_arguments(parser)
     args = parser.parse_args()
     if not args.drop:
         args.drop = params['resize']['to-drop']
@@ -59,85 +77,126 @@ def setup_args() -> argparse.Namespace:
 
 
 SAFE_COLS = {"id", "ClusterLatitude", "ClusterLongitude", "dateTimeGroup", "TimeWindowID", "Cluster"}
-Edit = namedtuple("Edit", ["row", "column", "old_value", "new_value"])
-
-
-def perturb(split: Path) -> List[Edit]:
-    history = []
-    shutil.copy(split / 'test.csv', split / 'test.csv.orig')
-    df = pd.read_csv(split / 'test.csv', index_col="id")
-    unsafe_cols = list(set(df.columns) - SAFE_COLS)
-    min_max = df.aggregate(['min', 'max'])
-    for i, data in df.iterrows():
-        chosen_cols = random.choices(unsafe_cols, k=random.randint(1, len(unsafe_cols)))
-        for col in chosen_cols:
-            if str(df.dtypes[col]).startswith("int"):
-                randfunc = random.randint
-            elif str(df.dtypes[col]).startswith("float"):
-                randfunc = random.uniform
-            else:
-                raise RuntimeError(f"I can't generate random values for {str(df.dtypes[col])}")
-            old = data[col]
-            data[col] = randfunc(min_max.loc['min', col], min_max.loc['max', col])
-            history.append(Edit(row=i, column=col, old_value=old, new_value=data[col]))
-        df.loc[i] = data
+
+
+def perturb(split: Path, split_id: int, seed: int = 42, fmt: str = 'csv') -> pd.DataFrame:
+    """Perturb every row of the testing set of a split, and return the edits."""
+    test = split / f'test{EXTENSIONS[fmt]}'
+    shutil.copy(test, test.with_name(test.name + '.orig'))
+    with phase('read') as record:
+        df = read_table(test).set_index("id")
+        record.rows = len(df)
+    unsafe_cols = [col for col in df.columns if col not in SAFE_COLS]
+    with phase('perturb', rows=len(df)):
+        history = perturb_rows(df, np.arange(len(df)), unsafe_cols, split_rng(seed, split_id))
     df["perturbed"] = 1
-    df.to_csv(split / 'test.csv', index=True)
-    return list(filter(lambda x: x.old_value != x.new_value, history))
+    with phase('write', rows=len(df)):
+        write_table(df, test, fmt=fmt, index=True)
+    return history
+
+
+def train_projection(drop: Tuple[str] = ()) -> dict:
+    """How the rows of the windows are changed in the training set, for the manifests of the virtual splits."""
+    return {'drop': list(drop), 'index-label': 'id', 'constants': {'perturbed': 0}}
 
 
-def generate_train_set(outfile: Path, files: Union[List[Path], Path], drop: Tuple[str] = ()):
-    header = True
-    files = [files] if type(files) is not list else files
-    for file in files:
-        reader = pd.read_csv(file, usecols=lambda x: not x.startswith(drop), chunksize=1000)
-        for chunk in reader:
-            chunk["perturbed"] = 0
-            chunk.to_csv(outfile, index=True, index_label='id', header=header, mode='a')
-        header = False
+def generate_train_set(outfile: Path, directory: Path, windows: Union[List[int], int], drop: Tuple[str] = (),
+                       fmt: str = 'csv'):
+    windows = [windows] if type(windows) is not list else windows
+    with TableWriter(outfile, index=True, index_label='id') as writer:
+        chunks = iter_windows(directory, windows, fmt=fmt, columns=lambda x: not x.startswith(drop))
+        for _, df in timed_chunks('read', chunks, rows=lambda item: len(item[1])):
+            df["perturbed"] = 0
+            with phase('write', rows=len(df)):
+                writer.write(df)
 
 
 def generate_split(output: Path,
-                   files: List[Path],
+                   directory: Path,
+                   windows: List[int],
+                   signatures: List[str],
                    i: int,
                    to_perturb: Set[int] = None,
-                   drop: Tuple[str] = ()):
+                   seed: int = 42,
+                   drop: Tuple[str] = (),
+                   fmt: str = 'csv',
+                   virtual: bool = False):
+    """Create the i-th split, with the windows before the i-th as training set and the i-th as testing set.
+
+    Only the sets that don't match the manifest of the split (if it already exists) are written.
+    """
     folder = output / f"split-{i}"
     folder.mkdir(exist_ok=True, parents=True)
-    generate_train_set(folder / 'train.csv', files[0:i], drop=drop)
-    generate_train_set(folder / 'test.csv', files[i], drop=drop)
-    with open(folder / 'contained-windows.yaml', "w") as f:
-        yaml.safe_dump({
-            'training-windows': [str(x.name) for x in files[0:i]],
-            'testing': {
-                'window': str(files[i].name),
-                'is-perturbed': i in to_perturb
-            }
-        }, f)
-    if i in to_perturb:
-        history = perturb(folder)
-        pd.DataFrame(data=history).to_csv(folder / 'perturbations.csv', index=False)
-    else:
-        df = pd.read_csv(folder / 'test.csv', index_col="id")
-        df["perturbed"] = 0
-        df.to_csv(folder / 'test.csv', index=True)
+    test = folder / f'test{EXTENSIONS[fmt]}'
+    manifest = {
+        'training-windows': [Path(window_name(directory, x, fmt)).name for x in windows[0:i]],
+        'training-signatures': signatures[0:i],
+        'testing': {
+            'window': Path(window_name(directory, windows[i], fmt)).name,
+            'signature': signatures[i],
+            'is-perturbed': i in to_perturb
+        },
+        'format': fmt,
+        'dropped-columns': list(drop),
+        'perturbation': {'seed': seed},
+    }
+    if virtual:
+        manifest.update(virtual_manifest(folder, directory, windows[0:i], projection=train_projection(drop)))
+    stale = stale_sets(folder, manifest)
+    if not stale:
+        return
+
+    if 'train' in stale and virtual:
+        (folder / f'train{EXTENSIONS[fmt]}').unlink(missing_ok=True)
+    elif 'train' in stale:
+        generate_train_set(folder / f'train{EXTENSIONS[fmt]}', directory, windows[0:i], drop=drop, fmt=fmt)
+    if 'test' in stale:
+        generate_train_set(test, directory, windows[i], drop=drop, fmt=fmt)
+        if i in to_perturb:
+            history = perturb(folder, i, seed=seed, fmt=fmt)
+            history.to_csv(folder / 'perturbations.csv', index=False)
+        else:
+            (folder / 'perturbations.csv').unlink(missing_ok=True)
+            test.with_name(test.name + '.orig').unlink(missing_ok=True)
+    # The manifest is written last, so that the sets of an interrupted run are rebuilt
+    with open(folder / MANIFEST_NAME, "w") as f:
+        yaml.safe_dump(manifest, f)
+
+
+def split_costs(sizes: List[int], to_perturb: Set[int], virtual: bool = False) -> List[TaskCost]:
+    """Estimate the cost of each split (from the 1st on) from the bytes of the windows, which split i copies i of."""
+    copied = np.cumsum(sizes)
+    costs = []
+    for i in range(1, len(sizes)):
+        train = 0 if virtual else copied[i - 1]
+        test = sizes[i] * (2 * TABLE_COST + (2 * TABLE_COST + PERTURB_COST if i in to_perturb else 0))
+        read = sizes[i] if virtual else max(sizes[:i + 1])
+        costs.append(TaskCost(train * 2 * TABLE_COST + test, WORKER_MEMORY + MEMORY_FACTOR * read, train + sizes[i]))
+    return costs
 
 
 def main():
+    logging.basicConfig(level=logging.INFO)
     args = setup_args()
-    random.seed(args.seed, version=2)
     directory = Path(args.directory).absolute()
     output = Path(args.output).absolute()
-    shutil.rmtree(output, ignore_errors=True)
+    if not args.incremental:
+        shutil.rmtree(output, ignore_errors=True)
     output.mkdir(exist_ok=True, parents=True)
-    files = sorted(directory.glob('window-*.csv'), key=lambda x: int(str(x.name)[7:-4]))
-    to_perturb = set(random.sample(range(1, len(files)), int((len(files) - 1) * args.fraction)))
+    fmt = store_format(directory) if is_store(directory) else args.format
+    windows = list_windows(directory, fmt)
+    remove_splits(output, len(windows))
+    to_perturb = perturbed_splits(list(range(1, len(windows))), args.fraction, seed=args.seed)
     with open(output / "perturbed-splits.yaml", 'w') as f:
         yaml.safe_dump({
             'perturbed-splits': sorted(list(to_perturb))
         }, f)
-    func = partial(generate_split, output, files, to_perturb=to_perturb, drop=args.drop)
-    p_umap(func, range(1, len(files)))
+    with instrumented('create-train-test-v2', args.metrics, args.profile):
+        func = partial(generate_split, output, directory, windows, window_signatures(directory, windows, fmt),
+                       to_perturb=to_perturb, seed=args.seed, drop=args.drop, fmt=fmt, virtual=args.virtual)
+        costs = split_costs(window_sizes(directory, windows, fmt), to_perturb, virtual=args.virtual)
+        list(merge_phases(scheduled_map(gathered(func), range(1, len(windows)), costs, args.jobs,
+                                        writers=args.writers)))
 
 
 if __name__ == '__main__':
@@ -16,16 +16,25 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import logging
+import os
 import shutil
-from collections import namedtuple
 from functools import partial
 from pathlib import Path
-import random
 from typing import List
 
+import numpy as np
 import pandas as pd
 import yaml
-from p_tqdm import p_umap
+
+from instrumentation import add_metrics_arguments, gathered, instrumented, merge_phases, phase, timed_chunks
+from parallel import TaskCost, scheduled_map
+from perturbation import perturb_rows, split_rng
+from splits import (COPY_COST, MANIFEST_NAME, MEMORY_FACTOR, PERTURB_COST, TABLE_COST, WORKER_MEMORY, remove_splits,
+                    stale_sets, virtual_manifest)
+from tableio import EXTENSIONS, TableWriter, add_format_argument, write_table
+from windowstore import (is_store, iter_windows, list_windows, store_format, window_name, window_path,
+                         window_signatures, window_sizes)
 
 
 def setup_args() -> argparse.Namespace:
@@ -47,44 +56,48 @@ def setup_args() -> argparse.Namespace:
                         default=params['create-train-test']['perturbed-fraction'],
                         type=float,
                         help="Fraction of data to be perturbed")
+    add_format_argument(parser, "Format of the windows, and of the splits", default='csv')
+    parser.add_argument('--virtual', action='store_true',
+                        help="List the training windows of each split in its manifest instead of copying them")
+    parser.add_argument('--keep-original', action='store_true',
+                        help="Keep a copy of each testing set before the perturbation (test.csv.orig)")
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help="Only create the splits (or their sets) that changed since the last run")
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count())
+    parser.add_argument('--writers', type=int, default=None,
+                        help="Most splits with large sets written at once (e.g. on a slow disk). Defaults to --jobs")
+    add_metrics_arguments(parser)
     return parser.parse_args()
 
 
 SAFE_COLS = {"ClusterLatitude", "ClusterLongitude", "dateTimeGroup", "TimeWindowID", "Cluster"}
-Edit = namedtuple("Edit", ["row", "column", "old_value", "new_value"])
-
-
-def perturb(split: Path, fraction: float = 0.1, seed: int = 42) -> List[Edit]:
-    history = []
-    shutil.copy(split / 'test.csv', split / 'test.csv.orig')
-    df = pd.read_csv(split / 'test.csv')
-    unsafe_cols = list(set(df.columns) - SAFE_COLS)
-    min_max = df.aggregate(['min', 'max'])
-    perturbed_data = df.sample(frac=fraction, random_state=seed)
-    for i, data in perturbed_data.iterrows():
-        chosen_cols = random.choices(unsafe_cols, k=random.randint(1, len(unsafe_cols)))
-        for col in chosen_cols:
-            if str(df.dtypes[col]).startswith("int"):
-                randfunc = random.randint
-            elif str(df.dtypes[col]).startswith("float"):
-                randfunc = random.uniform
-            else:
-                raise RuntimeError(f"I can't generate random values for {str(df.dtypes[col])}")
-            old = data[col]
-            data[col] = randfunc(min_max.loc['min', col], min_max.loc['max', col])
-            history.append(Edit(row=i, column=col, old_value=old, new_value=data[col]))
-        perturbed_data.loc[i] = data
-    df["perturbed"] = False
-    df.loc[perturbed_data.index, "perturbed"] = True
-    df.update(perturbed_data)
-    df.to_csv(split / 'test.csv', index=False)
-    return list(filter(lambda x: x.old_value != x.new_value, history))
 
 
-def generate_train_set(folder: Path, files: List[Path]):
-    with open(folder / 'train.csv', 'w') as dest:
-        for j, file in enumerate(files):
-            with open(file, 'r') as source:
+def perturb(df: pd.DataFrame, fraction: float = 0.1, rng: np.random.Generator = None) -> pd.DataFrame:
+    """Perturb in place a random ``fraction`` of the rows of a testing window, and return the edits.
+
+    The perturbed rows are flagged in the ``perturbed`` column.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    rows = np.sort(rng.choice(len(df), size=round(fraction * len(df)), replace=False))
+    history = perturb_rows(df, rows, [col for col in df.columns if col not in SAFE_COLS], rng)
+    df["perturbed"] = False
+    df.iloc[rows, df.columns.get_loc("perturbed")] = True
+    return history
+
+
+def generate_train_set(folder: Path, directory: Path, windows: List[int], fmt: str = 'csv'):
+    if fmt != 'csv' or is_store(directory):
+        with TableWriter(folder / f'train{EXTENSIONS[fmt]}', fmt=fmt) as writer:
+            chunks = iter_windows(directory, windows, fmt=fmt)
+            for _, df in timed_chunks('read', chunks, rows=lambda item: len(item[1])):
+                with phase('write', rows=len(df)):
+                    writer.write(df)
+        return
+
+    with phase('copy'), open(folder / 'train.csv', 'w') as dest:
+        for j, window in enumerate(windows):
+            with open(window_path(directory, window), 'r') as source:
                 # Skip the header if it is not the first file
                 if j != 0:
                     next(source)
@@ -93,29 +106,88 @@ def generate_train_set(folder: Path, files: List[Path]):
                     dest.write(line)
 
 
-def generate_split(output: Path, files: List[Path], i: int, fraction: float = 0.1, seed: int = 42):
+def generate_split(output: Path, directory: Path, windows: List[int], signatures: List[str], i: int,
+                   fraction: float = 0.1, seed: int = 42, fmt: str = 'csv', virtual: bool = False,
+                   keep_original: bool = False):
+    """Create the i-th split, with the windows before the i-th as training set and the i-th as testing set.
+
+    Only the sets that don't match the manifest of the split (if it already exists) are written.
+    """
     folder = output / f"split-{i}"
     folder.mkdir(exist_ok=True, parents=True)
-    generate_train_set(folder, files[0:i])
-    shutil.copy(files[i], folder / 'test.csv')
-    with open(folder / 'contained-windows.yaml', "w") as f:
-        yaml.safe_dump({
-            'training-windows': [str(x) for x in files[0:i]],
-            'testing-window': str(files[i])
-        }, f)
-    history = perturb(folder, fraction=fraction, seed=seed)
-    pd.DataFrame(data=history).to_csv(folder / 'perturbations.csv', index=False)
+    manifest = {
+        'training-windows': [window_name(directory, x, fmt) for x in windows[0:i]],
+        'training-signatures': signatures[0:i],
+        'testing-window': window_name(directory, windows[i], fmt),
+        'testing-signature': signatures[i],
+        'format': fmt,
+        'perturbation': {'seed': seed, 'fraction': fraction, 'original-kept': keep_original},
+    }
+    if virtual:
+        manifest.update(virtual_manifest(folder, directory, windows[0:i]))
+    stale = stale_sets(folder, manifest)
+    if not stale:
+        return
+
+    if 'train' in stale and virtual:
+        (folder / f'train{EXTENSIONS[fmt]}').unlink(missing_ok=True)
+    elif 'train' in stale:
+        generate_train_set(folder, directory, windows[0:i], fmt=fmt)
+    if 'test' in stale:
+        test = folder / f'test{EXTENSIONS[fmt]}'
+        original = test.with_name(test.name + '.orig')
+        with phase('read') as record:
+            _, df = next(iter_windows(directory, [windows[i]], fmt=fmt))
+            record.rows = len(df)
+        if keep_original and is_store(directory):
+            write_table(df, original, fmt=fmt)
+        elif keep_original:
+            shutil.copy(window_path(directory, windows[i], fmt), original)
+        else:
+            original.unlink(missing_ok=True)
+        with phase('perturb', rows=len(df)):
+            history = perturb(df, fraction=fraction, rng=split_rng(seed, i))
+        with phase('write', rows=len(df)):
+            write_table(df, test, fmt=fmt)
+        history.to_csv(folder / 'perturbations.csv', index=False)
+    # The manifest is written last, so that the sets of an interrupted run are rebuilt
+    with open(folder / MANIFEST_NAME, "w") as f:
+        yaml.safe_dump(manifest, f)
+
+
+def split_costs(sizes: List[int], fmt: str = 'csv', store: bool = False, virtual: bool = False) -> List[TaskCost]:
+    """Estimate the cost of each split (from the 1st on) from the bytes of the windows, which split i copies i of."""
+    copied = np.cumsum(sizes)
+    costs = []
+    for i in range(1, len(sizes)):
+        train = 0 if virtual else copied[i - 1]
+        # The training windows are copied as they are, or read and written one at a time
+        table = fmt != 'csv' or store
+        seconds = train * (2 * TABLE_COST if table else COPY_COST) + sizes[i] * (2 * TABLE_COST + PERTURB_COST)
+        read = max(sizes[:i + 1]) if table and not virtual else sizes[i]
+        costs.append(TaskCost(seconds, WORKER_MEMORY + MEMORY_FACTOR * read, train + sizes[i]))
+    return costs
 
 
 def main():
+    logging.basicConfig(level=logging.INFO)
     args = setup_args()
     directory = Path(args.directory)
     output = Path(args.output)
-    shutil.rmtree(output, ignore_errors=True)
+    if not args.incremental:
+        shutil.rmtree(output, ignore_errors=True)
     output.mkdir(exist_ok=True, parents=True)
-    files = sorted(directory.glob('window-*.csv'), key=lambda x: int(str(x.name)[7:-4]))
-    func = partial(generate_split, output, files, fraction=args.fraction, seed=args.seed)
-    p_umap(func, range(1, len(files)))
+    fmt = store_format(directory) if is_store(directory) else args.format
+    with instrumented('create-train-test', args.metrics, args.profile):
+        windows = list_windows(directory, fmt)
+        remove_splits(output, len(windows))
+        func = partial(generate_split, output, directory, windows, window_signatures(directory, windows, fmt),
+                       fraction=args.fraction, seed=args.seed, fmt=fmt, virtual=args.virtual,
+                       keep_original=args.keep_original)
+        costs = split_costs(window_sizes(directory, windows, fmt), fmt=fmt, store=is_store(directory),
+                            virtual=args.virtual)
+        list(merge_phases(scheduled_map(gathered(func), range(1, len(windows)), costs, args.jobs,
+                                        writers=args.writers)))
 
 
 if __name__ == '__main__':
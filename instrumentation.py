@@ -0,0 +1,226 @@
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""The wall time, CPU time, peak memory and rows of the phases of a stage, written as DVC metrics.
+
+A stage runs its work inside ``instrumented``, and marks its expensive phases (e.g. read, encode, write) with
+``phase``, ``timed`` or ``timed_chunks``. The phases are recorded by the process that runs them: the ones run by a
+pool of workers are sent back with the results of the tasks by wrapping the task in ``gathered``. Each phase adds up
+all the times it ran, and phases can be nested (each counts its whole time). The peak memory of a phase is the one of
+the process (and of its finished children) when the phase ended.
+
+The metrics are a JSON file, to be declared as ``metrics`` in ``dvc.yaml`` and compared with ``dvc metrics diff``.
+One phase can also be profiled with cProfile, in all the processes that run it, into a single ``.prof`` file.
+"""
+
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import resource
+import time
+from contextlib import contextmanager
+from functools import partial, wraps
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple, Union
+
+
+def add_metrics_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--metrics', default=None,
+                        help="Write the time, memory and rows of each phase of the stage to this JSON file")
+    parser.add_argument('--profile', default=None, metavar='PHASE',
+                        help="Profile PHASE with cProfile, next to the metrics (or in the current directory)")
+
+
+def cpu_time() -> float:
+    """The CPU time used by this process and by its finished children, in seconds."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def peak_rss_mb() -> float:
+    """The peak resident memory of this process, or of the largest of its finished children, in MiB."""
+    # ru_maxrss is in KiB on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+class PhaseRecord:
+    """The rows processed by a running phase, that it can add to."""
+
+    def __init__(self, rows: int = 0):
+        self.rows = rows
+
+
+class Recorder:
+    def __init__(self):
+        self.phases: Dict[str, dict] = {}
+        self.profiled: Optional[str] = None
+        self.profile_path: Optional[Path] = None
+        self.profiler: Optional[cProfile.Profile] = None
+
+    def add(self, name: str, seconds: float, cpu_seconds: float, rows: int, max_rss_mb: float, calls: int = 1):
+        measures = self.phases.setdefault(name, {'calls': 0, 'seconds': 0.0, 'cpu_seconds': 0.0, 'rows': 0,
+                                                 'max_rss_mb': 0.0})
+        measures['calls'] += calls
+        measures['seconds'] += seconds
+        measures['cpu_seconds'] += cpu_seconds
+        measures['rows'] += rows
+        measures['max_rss_mb'] = max(measures['max_rss_mb'], max_rss_mb)
+
+    def merge(self, phases: Dict[str, dict]):
+        for name, measures in phases.items():
+            self.add(name, measures['seconds'], measures['cpu_seconds'], measures['rows'], measures['max_rss_mb'],
+                     calls=measures['calls'])
+
+    def dump_profile(self):
+        """Write the profile of this process, in a file of its own (merged by ``write_profile``)."""
+        if self.profiler is not None:
+            self.profiler.dump_stats(f"{self.profile_path}.{os.getpid()}")
+
+    def profile_parts(self) -> list:
+        return sorted(self.profile_path.parent.glob(f"{self.profile_path.name}.*"))
+
+    def write_profile(self):
+        self.dump_profile()
+        parts = self.profile_parts()
+        if parts:
+            pstats.Stats(*map(str, parts)).dump_stats(str(self.profile_path))
+        for part in parts:
+            part.unlink()
+
+
+_recorder = Recorder()
+
+
+@contextmanager
+def phase(name: str, rows: int = 0) -> Iterator[PhaseRecord]:
+    """Record the time and memory of the block as the phase ``name``, with the ``rows`` it processed (the block can
+    add to ``record.rows``)."""
+    record = PhaseRecord(rows)
+    profiler = None
+    if name == _recorder.profiled:
+        if _recorder.profiler is None:
+            _recorder.profiler = cProfile.Profile()
+        profiler = _recorder.profiler
+        profiler.enable()
+    start, cpu_start = time.perf_counter(), cpu_time()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        _recorder.add(name, time.perf_counter() - start, cpu_time() - cpu_start, record.rows, peak_rss_mb())
+
+
+def timed(name: str, rows: Callable[[Any], int] = None) -> Callable:
+    """Decorate a function to record each of its calls as the phase ``name``, with the rows of its result given by
+    ``rows`` (if any)."""
+
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name) as record:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    record.rows += rows(result)
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def timed_chunks(name: str, chunks: Iterable, rows: Callable[[Any], int] = len) -> Iterator:
+    """Yield the ``chunks``, recording the time taken to produce them as the phase ``name``.
+
+    The rows of each chunk are given by ``rows``.
+    """
+    chunks = iter(chunks)
+    while True:
+        with phase(name) as record:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            record.rows += rows(chunk)
+        yield chunk
+
+
+def _gathered(func: Callable, *args, **kwargs) -> Tuple[Any, Dict[str, dict]]:
+    outer = _recorder.phases
+    _recorder.phases = {}
+    try:
+        result = func(*args, **kwargs)
+        _recorder.dump_profile()
+        return result, _recorder.phases
+    finally:
+        _recorder.phases = outer
+
+
+def gathered(func: Callable) -> Callable:
+    """Wrap a task run by a pool of workers so that it returns its result together with the phases it recorded.
+
+    The stage adds them to its own with ``merge_phases``. The wrapped task can be pickled if ``func`` can.
+    """
+    return partial(_gathered, func)
+
+
+def merge_phases(results: Iterable[Tuple[Any, Dict[str, dict]]]) -> Iterator:
+    """Yield the results of ``gathered`` tasks, adding the phases they recorded to the ones of the stage."""
+    for result, phases in results:
+        _recorder.merge(phases)
+        yield result
+
+
+def metrics(seconds: float, cpu_seconds: float, phases: Dict[str, dict]) -> dict:
+    summary = {'seconds': round(seconds, 3), 'cpu_seconds': round(cpu_seconds, 3),
+               'max_rss_mb': round(peak_rss_mb(), 1), 'phases': {}}
+    for name, measures in phases.items():
+        summary['phases'][name] = {
+            'calls': measures['calls'],
+            'seconds': round(measures['seconds'], 3),
+            'cpu_seconds': round(measures['cpu_seconds'], 3),
+            'max_rss_mb': round(measures['max_rss_mb'], 1),
+            'rows': measures['rows'],
+            'rows_per_second': round(measures['rows'] / measures['seconds']) if measures['seconds'] else 0,
+        }
+    return summary
+
+
+@contextmanager
+def instrumented(stage: str, output: Union[str, Path] = None, profile: str = None) -> Iterator[Recorder]:
+    """Record the phases of the ``stage`` run in the block, and write their metrics to ``output`` (if given).
+
+    The phase ``profile`` (if given) is profiled into ``<output>.<profile>.prof``, or ``<stage>.<profile>.prof`` in the
+    current directory without an ``output``.
+    """
+    _recorder.phases = {}
+    _recorder.profiled = profile
+    _recorder.profile_path = Path(f"{output or stage}.{profile}.prof").absolute() if profile else None
+    if profile:
+        # The parts left by an interrupted run
+        for part in _recorder.profile_parts():
+            part.unlink()
+    start, cpu_start = time.perf_counter(), cpu_time()
+    yield _recorder
+    seconds, cpu_seconds = time.perf_counter() - start, cpu_time() - cpu_start
+    if output:
+        Path(output).parent.mkdir(parents=True, exist_ok=True)
+        with open(output, 'w') as f:
+            json.dump(metrics(seconds, cpu_seconds, _recorder.phases), f, indent=2)
+    if profile:
+        _recorder.write_profile()
@@ -0,0 +1,125 @@
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Process pools for the stages whose results must keep the order of their inputs (``p_umap`` doesn't), or whose tasks
+have very different costs."""
+
+import logging
+import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Callable, Iterable, Iterator, Sequence, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+# The estimated cost of a task: the seconds it takes, the bytes of memory it needs and the bytes it writes
+TaskCost = namedtuple('TaskCost', ['seconds', 'memory', 'writes'])
+
+
+def ordered_map(func: Callable, tasks: Iterable[tuple], jobs: int) -> Iterator:
+    """Run ``func`` on each task in a pool of ``jobs`` processes and yield the results in the order of ``tasks``.
+
+    At most two tasks per process are submitted ahead of the one being waited for, so that a slow consumer doesn't
+    make the tasks pile up in memory. With a single job the tasks are run in this process.
+    """
+    if jobs == 1:
+        yield from (func(*task) for task in tasks)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(func, *task))
+            if len(pending) > 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def available_memory() -> int:
+    """The bytes of memory that can be used without swapping."""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def _timed_call(func: Callable, task: Any) -> Tuple[Any, float]:
+    start = time.perf_counter()
+    result = func(task)
+    return result, time.perf_counter() - start
+
+
+def scheduled_map(func: Callable, tasks: Sequence, costs: Sequence[TaskCost], jobs: int, writers: int = None,
+                  memory: int = None) -> Iterator:
+    """Run ``func`` on each of the ``tasks`` in a pool of ``jobs`` processes and yield the results as they complete.
+
+    The tasks are started from the costliest (by their estimated ``costs``), so that the long ones don't end up
+    running alone at the end. A task is only started while the memory of the running ones leaves room for it (within
+    ``memory``, by default the available one), and at most ``writers`` of the heavy writers (the half of the tasks that
+    write the most) run at once. With a single job the tasks are run in this process. The time spent in the tasks, and
+    the share of the time of the processes it took, is logged at the end.
+    """
+    jobs = max(1, min(jobs, len(tasks)))
+    writers = writers or jobs
+    memory = memory or available_memory()
+    writes = [cost.writes for cost in costs]
+    heavy = [w >= np.median(writes) for w in writes]
+    pending = sorted(range(len(tasks)), key=lambda i: costs[i].seconds, reverse=True)
+    start = time.perf_counter()
+    seconds = []
+
+    def startable(i: int, running: Iterable[int]) -> bool:
+        running = list(running)
+        # With nothing running any task can start, however big
+        if not running:
+            return True
+        if heavy[i] and sum(heavy[j] for j in running) >= writers:
+            return False
+        return sum(costs[j].memory for j in running) + costs[i].memory <= memory
+
+    with tqdm(total=len(tasks)) as progress:
+        if jobs == 1:
+            for i in pending:
+                result, elapsed = _timed_call(func, tasks[i])
+                seconds.append(elapsed)
+                progress.update()
+                yield result
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                running = {}
+                while pending or running:
+                    while len(running) < jobs:
+                        i = next((i for i in pending if startable(i, running.values())), None)
+                        if i is None:
+                            break
+                        pending.remove(i)
+                        running[executor.submit(_timed_call, func, tasks[i])] = i
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        del running[future]
+                        result, elapsed = future.result()
+                        seconds.append(elapsed)
+                        progress.update()
+                        yield result
+    wall, work = time.perf_counter() - start, sum(seconds)
+    logging.info("Ran %d tasks in %.1f s with %d processes: %.1f s of work, %.0f%% utilization (at best %.1f s)",
+                 len(tasks), wall, jobs, work, 100 * work / (wall * jobs) if wall else 100,
+                 max([work / jobs, *seconds]))
@@ -0,0 +1,120 @@
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Perturbation of the testing sets, a whole window at a time.
+
+Each perturbed row gets random values, drawn uniformly between the minimum and the maximum of the column, in a
+random subset of its columns. The random numbers come from a generator seeded with the seed of the run and the split,
+so a split is perturbed in the same way whatever the order (or the process) in which the splits are created.
+"""
+
+from typing import List, Set
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_float_dtype, is_integer_dtype
+
+# The columns of the history of the edits, one row per edited cell
+EDIT_COLS = ["row", "column", "old_value", "new_value"]
+
+
+def split_rng(seed: int, split: int) -> np.random.Generator:
+    return np.random.default_rng([seed, split])
+
+
+def perturbed_splits(splits: List[int], fraction: float, seed: int = 42) -> Set[int]:
+    """Choose ``int(len(splits) * fraction)`` of the ``splits`` to perturb.
+
+    Each split gets a random key from its own generator, and the ones with the smallest keys are chosen: adding some
+    splits changes the choice as little as possible, which is what makes the incremental runs cheap.
+    """
+    keys = {split: np.random.default_rng([seed, split, 1]).random() for split in splits}
+    return set(sorted(splits, key=keys.get)[:int(len(splits) * fraction)])
+
+
+def column_masks(rng: np.random.Generator, rows: int, columns: int) -> np.ndarray:
+    """Choose the columns to perturb in each row.
+
+    Each row draws, with replacement, between 1 and ``columns`` columns, as ``random.choices`` did.
+    """
+    draws = rng.integers(1, columns, size=rows, endpoint=True)
+    masks = np.zeros((rows, columns), dtype=bool)
+    masks[np.repeat(np.arange(rows), draws), rng.integers(0, columns, size=draws.sum())] = True
+    return masks
+
+
+def same_values(new: np.ndarray, old: np.ndarray) -> np.ndarray:
+    """Compare two arrays element by element, with the missing values (NaN or NA) equal to each other."""
+    missing_new, missing_old = pd.isna(new), pd.isna(old)
+    same = missing_new & missing_old
+    present = ~(missing_new | missing_old)
+    same[present] = new[present] == old[present]
+    return same
+
+
+def perturb_rows(df: pd.DataFrame, rows: np.ndarray, columns: List[str], rng: np.random.Generator) -> pd.DataFrame:
+    """Perturb in place the ``rows`` (positions) of ``df`` in some of its ``columns``, and return the edits.
+
+    The edits that didn't change the value of their cell are not returned.
+    """
+    if len(rows) == 0 or not columns:
+        return pd.DataFrame(columns=EDIT_COLS)
+    masks = column_masks(rng, len(rows), len(columns))
+    dtypes = df.dtypes[columns]
+    integers = np.array([is_integer_dtype(dtype) for dtype in dtypes])
+    floats = np.array([is_float_dtype(dtype) for dtype in dtypes])
+    unsupported = masks[:, ~(integers | floats)].any(axis=0)
+    if unsupported.any():
+        dtype = dtypes[~(integers | floats)][unsupported].iloc[0]
+        raise RuntimeError(f"I can't generate random values for {str(dtype)}")
+
+    # Unlike aggregate(['min', 'max']), which runs once per column, min and max reduce all the columns at once
+    lows, highs = df[columns].min(), df[columns].max()
+    history = []
+    for kind, selected in (('int', integers), ('float', floats)):
+        if not selected.any():
+            continue
+        names = [col for col, keep in zip(columns, selected) if keep]
+        chosen = masks[:, selected]
+        # Only the values of the chosen cells are drawn
+        row_ids, col_ids = np.nonzero(chosen)
+        if kind == 'int':
+            # The columns without any value (e.g. a nullable Int64 that is all NA) have nothing to draw from
+            empty = (lows[names].isna() | highs[names].isna()).to_numpy()
+            chosen = chosen & ~empty
+            drawn = ~empty[col_ids]
+            row_ids, col_ids = row_ids[drawn], col_ids[drawn]
+            low = lows[names].fillna(0).to_numpy(dtype='int64')
+            high = highs[names].fillna(0).to_numpy(dtype='int64')
+            values = rng.integers(low[col_ids], high[col_ids], endpoint=True)
+        else:
+            low = lows[names].to_numpy(dtype=float, na_value=np.nan)
+            high = highs[names].to_numpy(dtype=float, na_value=np.nan)
+            values = rng.uniform(low[col_ids], high[col_ids])
+        old = df[names].iloc[rows].to_numpy()
+        new = old.copy()
+        new[row_ids, col_ids] = values
+        df.iloc[rows, [df.columns.get_loc(col) for col in names]] = new
+
+        row_ids, col_ids = np.nonzero(chosen & ~same_values(new, old))
+        history.append(pd.DataFrame({
+            'row': df.index[rows][row_ids],
+            'column': np.array(names, dtype=object)[col_ids],
+            'old_value': old[row_ids, col_ids].astype(object),
+            'new_value': new[row_ids, col_ids].astype(object),
+        }))
+    if not history:
+        return pd.DataFrame(columns=EDIT_COLS)
+    return pd.concat(history, ignore_index=True).sort_values(['row'], kind='mergesort', ignore_index=True)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Plot the clusterings evaluated by silhouette.py, from the summaries of their
+# clusters and the sample of their rows it saved: the distribution of the
+# silhouette of each cluster, and the rows (binned in hexagons, or a scatter
+# plot of them) with the centroids. Only the chosen k are plotted (all of them
+# by default), and only if their plot is older than the data it comes from.
+
+import argparse
+from pathlib import Path
+
+import matplotlib.cm as cm
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+
+def setup_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('directory', help="Output directory of silhouette.py")
+    parser.add_argument('k', nargs='*', type=int, help="Number of clusters of the clusterings to plot")
+    parser.add_argument('--scatter', action='store_true', help="Plot each row instead of binning them in hexagons")
+    parser.add_argument('--gridsize', default=50, type=int, help="Number of hexagons along the longitude")
+    parser.add_argument('--force', '-f', action='store_true', help="Plot even if the plot is up to date")
+    return parser.parse_args()
+
+
+def plot_clustering(directory: Path, k: int, scatter: bool = False, gridsize: int = 50):
+    summary = pd.read_csv(directory / f"{k:02d}-clusters.csv", index_col='cluster')
+    with np.load(directory / f"{k:02d}-points.npz") as data:
+        coordinates, labels, silhouette_avg = data['coordinates'], data['labels'], float(data['silhouette_score'])
+
+    fig, (ax1, ax2) = plt.subplots(1, 2)
+    fig.set_size_inches(18, 7)
+    ax1.set_xlim([-1, 1])
+    ax1.set_ylim([-1, k])
+
+    # The silhouettes of each cluster: from the 5th to the 95th percentile, the
+    # box between the quartiles, the median and the mean
+    colors = cm.nipy_spectral(summary.index.to_numpy(dtype=float) / k)
+    ax1.hlines(summary.index, summary['q05'], summary['q95'], colors=colors, alpha=0.7)
+    ax1.barh(summary.index, summary['q75'] - summary['q25'], left=summary['q25'], color=colors, alpha=0.7)
+    ax1.scatter(summary['q50'], summary.index, marker="|", c="k")
+    ax1.scatter(summary['mean'], summary.index, marker="o", s=10, c="k")
+    if k <= 50:
+        ax1.set_yticks(summary.index)
+    ax1.set_title("The silhouette of the various clusters.")
+    ax1.set_xlabel("The silhouette coefficient values")
+    ax1.set_ylabel("Cluster label")
+
+    # The vertical line for average silhouette score of all the values
+    ax1.axvline(x=silhouette_avg, color="red", linestyle="--")
+    ax1.set_xticks([-0.1, 0, 0.2, 0.4, 0.6, 0.8, 1])
+
+    # 2nd Plot showing the actual clusters formed
+    if scatter:
+        ax2.scatter(coordinates[:, 0], coordinates[:, 1], marker="o", s=30, lw=0, alpha=0.7,
+                    c=cm.nipy_spectral(labels.astype(float) / k), edgecolor="k")
+    else:
+        ax2.hexbin(coordinates[:, 0], coordinates[:, 1], gridsize=gridsize, bins='log', cmap='Greys', mincnt=1)
+
+    # Draw white circles at cluster centers
+    centers = summary[["ClusterLongitude", "ClusterLatitude"]].to_numpy()
+    ax2.scatter(centers[:, 0], centers[:, 1], marker="o", c="white", alpha=1, s=200, edgecolor="k")
+    for i, c in enumerate(centers):
+        ax2.scatter(c[0], c[1], marker="$%d$" % i, alpha=1, s=50, edgecolor="k")
+
+    ax2.set_title("The visualization of the clustered data.")
+    ax2.set_xlabel("Longitude")
+    ax2.set_ylabel("Latitude")
+
+    plt.suptitle(
+        "Silhouette analysis for KMeans clustering on sample data with n_clusters = %d" % k,
+        fontsize=14,
+        fontweight="bold",
+    )
+    plt.savefig(directory / f"{k:02d}-clusters.pdf")
+    plt.close(fig)
+
+
+def is_stale(directory: Path, k: int) -> bool:
+    plot = directory / f"{k:02d}-clusters.pdf"
+    sources = [directory / f"{k:02d}-clusters.csv", directory / f"{k:02d}-points.npz"]
+    return not plot.exists() or any(source.stat().st_mtime > plot.stat().st_mtime for source in sources)
+
+
+def main():
+    args = setup_args()
+    directory = Path(args.directory)
+    ks = args.k or sorted(int(path.name[:-len("-clusters.csv")]) for path in directory.glob('*-clusters.csv'))
+    for k in ks:
+        if args.force or is_stale(directory, k):
+            plot_clustering(directory, k, scatter=args.scatter, gridsize=args.gridsize)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,33 +16,50 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import shutil
 import sys
+from functools import partial
 from pathlib import Path
+from typing import List, Tuple
+
 import pandas as pd
-import re
-from p_tqdm import p_umap
+from p_tqdm import p_uimap
+
+from results import parse_path, partition_path, read_index, read_predictions, write_index
+from tableio import write_table
+from windowstore import file_signature
 
 
 def process_result(file: Path) -> pd.DataFrame:
-    match = re.match(r".*?tau1_(.*?)_epochs_(\d+?)datasets/.*?/split-(\d+?)/.*",
-                     str(file))
-    if not match:
-        raise AssertionError()
+    df = read_predictions(file)
+    for i, (key, value) in enumerate(parse_path(file).items()):
+        df.insert(i, key, value)
+    return df
 
-    tau1 = float(match.group(1))
-    epochs = int(match.group(2))
-    split = int(match.group(3))
 
-    cols = ["prediction", "actual"]
-    df = pd.read_csv(file, header=None, names=cols)
-    if (df.iloc[0] == cols).all():
-        df = df[1:].reset_index(drop=True)
-    df = df.apply(pd.to_numeric, downcast='integer')
-    df = df.rename(columns={k: k.title() for k in cols})
-    df.insert(0, 'Tau', tau1)
-    df.insert(1, 'Epochs', epochs)
-    df.insert(2, 'Split', split)
-    return df
+def ingest_result(store: Path, file: Path) -> Tuple[str, str]:
+    """Write a result file in its partition of the store, and return its path and signature for the index."""
+    path = partition_path(store, file)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write_table(read_predictions(file), path)
+    return str(file), file_signature(file)
+
+
+def ingest(files: List[Path], store: Path, incremental: bool = False):
+    """Write the result files in the store, one at a time. With ``incremental``, the ones already in the store
+    (with the same signature) are skipped, and the ones that no longer exist are removed from it."""
+    if not incremental:
+        shutil.rmtree(store, ignore_errors=True)
+    store.mkdir(parents=True, exist_ok=True)
+    index = read_index(store)
+    for removed in set(index) - set(map(str, files)):
+        partition_path(store, removed).unlink(missing_ok=True)
+        del index[removed]
+    pending = [file for file in files if index.get(str(file)) != file_signature(file)]
+    if pending:
+        for name, signature in p_uimap(partial(ingest_result, store), pending):
+            index[name] = signature
+    write_index(store, index)
 
 
 if __name__ == '__main__':
@@ -61,7 +78,17 @@ if __name__ == '__main__':
                         type=argparse.FileType('w'),
                         help="The name of the output file. Defaults to stdout",
                         default=sys.stdout)
+    parser.add_argument('--store', '-s', default=None,
+                        help="Write the results in this directory, as Parquet files partitioned by"
+                        " Tau, Epochs and Split, instead of a CSV")
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help="Only add to the store the result files that changed since the last run")
     args = parser.parse_args()
 
-    files = list(Path(args.infolder).glob("tau*datasets/oslo/split-*/test.csv.predictions"))
-    pd.concat(p_umap(process_result, files)).to_csv(args.out, index=False)
+    files = sorted(Path(args.infolder).glob("tau*datasets/oslo/split-*/test.csv.predictions"))
+    if args.store:
+        ingest(files, Path(args.store), incremental=args.incremental)
+    else:
+        # Each result is written as soon as it is read
+        for i, df in enumerate(p_uimap(process_result, files)):
+            df.to_csv(args.out, header=i == 0, index=False)
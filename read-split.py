@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# Write the training (or testing) set of a split as a single file, e.g. to
+# give the training set of a virtual split to a tool that needs a train.csv.
+
+import argparse
+
+from splits import export_split
+from tableio import STDIO, add_format_argument
+
+
+def setup_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('split', help="Directory of the split")
+    parser.add_argument('set', nargs='?', choices=['train', 'test'], default='train')
+    parser.add_argument('--output', '-o', default=STDIO, help="Output file. Defaults to stdout (only for CSV)")
+    add_format_argument(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = setup_args()
+    export_split(args.split, args.output, name=args.set, fmt=args.format)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,17 +16,23 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import os
 import shutil
-from collections import namedtuple
 from functools import partial
 from pathlib import Path
-import random
-from typing import List, Tuple
+from typing import Tuple
 
-import pandas as pd
 import yaml
 from p_tqdm import p_umap
 
+from instrumentation import add_metrics_arguments, gathered, instrumented, merge_phases, phase, timed_chunks
+from splits import DEFAULT_CHUNKSIZE, MANIFEST_NAME, derived_manifest, read_manifest, set_path, split_chunks
+from tableio import EXTENSIONS, TableWriter, add_format_argument
+from windowstore import file_signature
+
+# Written in each resized split, to tell whether the split it comes from changed
+STAMP_NAME = 'resized-from.yaml'
+
 
 def setup_args() -> argparse.Namespace:
     if Path("params.yaml").exists():
@@ -38,6 +44,14 @@ def setup_args() -> argparse.Namespace:
     parser.add_argument('directory', help='Directory containing the windows')
     parser.add_argument('output', help="Output directory")
     parser.add_argument('--drop', '-d', action='append')
+    add_format_argument(parser, "Format of the resized splits. Defaults to the one of the splits")
+    parser.add_argument('--incremental', '-i', action='store_true',
+                        help="Only resize the splits that changed since the last run")
+    parser.add_argument('--virtual', action='store_true',
+                        help="Don't write the resized sets, only the manifests to read them from the original splits")
+    parser.add_argument('--chunksize', '-c', type=int, default=DEFAULT_CHUNKSIZE,
+                        help="Number of rows resized at a time")
+    add_metrics_arguments(parser)
     args = parser.parse_args()
     if not args.drop:
         args.drop = params['resize']['to-drop']
@@ -45,31 +59,75 @@ def setup_args() -> argparse.Namespace:
     return args
 
 
-def fix_dataset(file: Path, output: Path, drop: Tuple[str] = ()):
-    reader = pd.read_csv(file, usecols=lambda x: not x.startswith(drop), chunksize=1000)
-    header = True
-    for chunk in reader:
-        chunk.to_csv(output / file.name, index=True, index_label='id', header=header, mode='a')
-        header = False
+def resize_projection(drop: Tuple[str] = ()) -> dict:
+    return {'drop': list(drop), 'index-label': 'id'}
+
 
+def fix_dataset(output: Path, name: str, chunksize: int = DEFAULT_CHUNKSIZE):
+    """Write the set ``name`` of the derived split in ``output``, reading it from its source split."""
+    manifest = read_manifest(output)
+    path = set_path(output, name, manifest)
+    # While the file is being written the set is still read from the source split
+    partial_path = path.with_name(path.name + '.partial')
+    with TableWriter(partial_path, fmt=manifest['format']) as writer:
+        for chunk in timed_chunks('read', split_chunks(output, name, chunksize=chunksize)):
+            with phase('write', rows=len(chunk)):
+                writer.write(chunk)
+    os.replace(partial_path, path)
 
-def fix_split(outdir: Path, split: Path, drop: Tuple[str] = ()):
+
+def fix_split(outdir: Path, split: Path, drop: Tuple[str] = (), fmt: str = None, virtual: bool = False,
+              chunksize: int = DEFAULT_CHUNKSIZE):
     output = outdir / split.absolute().name
     output.mkdir(exist_ok=True, parents=True)
-    fix_dataset(split / 'train.csv', output, drop=drop)
+    manifest = read_manifest(split)
+    fmt = fmt or manifest.get('format', 'csv')
+    # The manifest of a split made from the windows already has their signatures (and the perturbation): the files of
+    # the split are only looked at when it doesn't, and then just by their size and time of the last change
+    signatures = {}
+    if 'training-signatures' not in manifest:
+        signatures = {path.name: file_signature(path) for path in sorted(split.iterdir()) if path.is_file()}
+    stamp = {
+        'manifest': manifest,
+        'signatures': signatures,
+        'drop': list(drop),
+        'format': fmt,
+        'virtual': virtual,
+    }
+    if (output / STAMP_NAME).exists():
+        with open(output / STAMP_NAME, 'r') as f:
+            if yaml.safe_load(f) == stamp:
+                return
+
+    derived = derived_manifest(output, split, resize_projection(drop), fmt)
+    for name in ('train', 'test'):
+        for extension in EXTENSIONS.values():
+            (output / f'{name}{extension}').unlink(missing_ok=True)
+    with open(output / MANIFEST_NAME, 'w') as f:
+        yaml.safe_dump(derived, f)
     shutil.copy(split / 'perturbations.csv', output)
-    fix_dataset(split / 'test.csv', output, drop=drop)
+    if not virtual:
+        fix_dataset(output, 'train', chunksize=chunksize)
+        fix_dataset(output, 'test', chunksize=chunksize)
+    with open(output / STAMP_NAME, 'w') as f:
+        yaml.safe_dump(stamp, f)
 
 
 def main():
     args = setup_args()
     directory = Path(args.directory)
     output = Path(args.output)
-    shutil.rmtree(output, ignore_errors=True)
+    if not args.incremental:
+        shutil.rmtree(output, ignore_errors=True)
     output.mkdir(exist_ok=True, parents=True)
     files = list(directory.glob('split-*'))
-    func = partial(fix_split, output, drop=args.drop)
-    p_umap(func, files)
+    for resized in output.glob('split-*'):
+        if not (directory / resized.name).exists():
+            shutil.rmtree(resized)
+    func = partial(fix_split, output, drop=args.drop, fmt=args.format, virtual=args.virtual,
+                   chunksize=args.chunksize)
+    with instrumented('resizing', args.metrics, args.profile):
+        list(merge_phases(p_umap(gathered(func), files)))
 
 
 if __name__ == '__main__':
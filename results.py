@@ -0,0 +1,97 @@
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""The predictions of SparkGHSOM on the testing sets, merged by ``process-results.py``.
+
+The results are either a CSV file or a store: a directory of Parquet files partitioned (hive style, e.g.
+``Tau=0.7/Epochs=100/Split=3/``) by the parameters of the run, so that the parameters take no space in the files and
+the readers only open the partitions they ask for. Each result file of SparkGHSOM becomes a file of its partition, and
+the index of the store (``_ingested.yaml``, that the readers skip) lists the result files already in it, with their
+signature.
+"""
+
+import hashlib
+import re
+from pathlib import Path
+from typing import Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import yaml
+
+RESULT_COLS = ["Tau", "Epochs", "Split", "Prediction", "Actual"]
+PARTITIONING = pa.schema([('Tau', pa.float64()), ('Epochs', pa.int64()), ('Split', pa.int64())])
+INDEX_NAME = '_ingested.yaml'
+PATH_RE = r".*?tau1_(.*?)_epochs_(\d+?)datasets/.*?/split-(\d+?)/.*"
+
+
+def parse_path(file: Union[str, Path]) -> dict:
+    """Return the parameters of the run (``Tau``, ``Epochs`` and ``Split``) that produced a result file."""
+    match = re.match(PATH_RE, str(file))
+    if not match:
+        raise AssertionError()
+    return {'Tau': float(match.group(1)), 'Epochs': int(match.group(2)), 'Split': int(match.group(3))}
+
+
+def read_predictions(file: Union[str, Path]) -> pd.DataFrame:
+    """Read the ``Prediction`` and ``Actual`` columns of a result file, that may or may not have a header."""
+    cols = ["prediction", "actual"]
+    df = pd.read_csv(file, header=None, names=cols)
+    if len(df) and (df.iloc[0] == cols).all():
+        df = df[1:].reset_index(drop=True)
+    df = df.apply(pd.to_numeric, downcast='integer')
+    return df.rename(columns={k: k.title() for k in cols})
+
+
+def partition_path(store: Union[str, Path], file: Union[str, Path]) -> Path:
+    """Where the result ``file`` is stored: a file named after its path, in the partition of its run."""
+    parameters = parse_path(file)
+    name = hashlib.blake2b(str(file).encode(), digest_size=8).hexdigest()
+    return Path(store).joinpath(*(f"{key}={value}" for key, value in parameters.items()), f"{name}.parquet")
+
+
+def read_index(store: Union[str, Path]) -> dict:
+    if not (Path(store) / INDEX_NAME).exists():
+        return {}
+    with open(Path(store) / INDEX_NAME, 'r') as f:
+        return yaml.safe_load(f) or {}
+
+
+def write_index(store: Union[str, Path], index: dict):
+    with open(Path(store) / INDEX_NAME, 'w') as f:
+        yaml.safe_dump(index, f)
+
+
+def is_store(path: Union[str, Path]) -> bool:
+    return Path(path).is_dir()
+
+
+def read_results(path: Union[str, Path], **equals) -> pd.DataFrame:
+    """Read the results in a CSV file or a store, only of the runs whose parameters are ``equals`` (e.g. ``Tau=0.7``).
+
+    Only the partitions of those runs are read from a store.
+    """
+    if not is_store(path):
+        df = pd.read_csv(path)
+        for key, value in equals.items():
+            df = df.loc[df[key] == value]
+        return df.reset_index(drop=True)
+    dataset = ds.dataset(path, format='parquet', partitioning=ds.partitioning(PARTITIONING, flavor='hive'))
+    condition: Optional[ds.Expression] = None
+    for key, value in equals.items():
+        condition = ds.field(key) == value if condition is None else condition & (ds.field(key) == value)
+    table = dataset.to_table(filter=condition)
+    return table.select(RESULT_COLS).to_pandas()
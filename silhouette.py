@@ -15,126 +15,327 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+# Choose the number of clusters, comparing the clusterings with k from --min
+# to --max. By default the clusterings are fitted in a single sweep, each one
+# starting from the previous one with its worst cluster split in two (and
+# evaluated by the workers as soon as it is fitted), and with --cache they are
+# kept (by dataset, seed, sweep and first k) for the next runs.
+# The silhouette is O(n^2) in the rows, so it is computed on
+# --repeats stratified samples of --sample rows (each cluster is sampled in
+# proportion to its size) and reported with its confidence interval, with the
+# pairwise distances computed in blocks of at most --working-memory MiB. The
+# inertia (for the elbow method) and the Calinski-Harabasz index are computed
+# on all the rows. The coordinates are written once as .npy files that the
+# workers memory-map, instead of being pickled to each of them.
+# Nothing is plotted: the silhouette of each cluster is summarized in --output
+# with a sample of the rows, for plot-silhouette.py to plot the chosen k.
+
 import argparse
+import hashlib
+import logging
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
 
-import matplotlib.cm as cm
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score, silhouette_samples
-from pathlib import Path
+import sklearn
+import yaml
 from p_tqdm import p_umap
+from scipy import stats
+from sklearn.cluster import KMeans
+from sklearn.metrics import calinski_harabasz_score, silhouette_samples
+from tqdm import tqdm
+
+from centroids import COORDINATES, ClusterAssigner, dedup_coordinates
+from tableio import read_table
+from transports import BOUNDS, PositionValidator
+
+SCORES_NAME = 'scores.csv'
+SWEEPS = ['warm', 'independent']
+SUMMARY_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+RESULT_COLS = ["n_clusters", "silhouette_score", "silhouette_low", "silhouette_high", "inertia", "calinski_harabasz"]
+
+# The centroids of a clustering and its inertia
+Fit = Tuple[np.ndarray, float]
+
+
+def share_arrays(directory: Path, **arrays: np.ndarray) -> Dict[str, str]:
+    """Write the ``arrays`` in ``directory``, to be memory-mapped by ``load_arrays``, and return their paths."""
+    paths = {}
+    for name, array in arrays.items():
+        paths[name] = str(directory / f"{name}.npy")
+        np.save(paths[name], array)
+    return paths
+
+
+def load_arrays(paths: Dict[str, str]) -> Dict[str, np.ndarray]:
+    return {name: np.load(path, mmap_mode='r') for name, path in paths.items()}
+
+
+def stratified_sample(labels: np.ndarray, size: int, rng: np.random.Generator) -> np.ndarray:
+    """Return the (sorted) positions of about ``size`` rows, drawn from each cluster in proportion to its size.
+
+    At least 2 rows of each cluster are drawn (if it has them), or their silhouette would be 0.
+    """
+    if size >= len(labels):
+        return np.arange(len(labels))
+    counts = np.bincount(labels)
+    quotas = np.minimum(counts, np.maximum(np.round(counts * size / len(labels)).astype(int), 2))
+    # The rows sorted by cluster, and randomly within each cluster: the first ones of each cluster are drawn
+    order = np.lexsort((rng.random(len(labels)), labels))
+    ranks = np.arange(len(labels)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.sort(order[ranks < np.repeat(quotas, counts)])
+
+
+def confidence_interval(values: List[float], confidence: float = 0.95) -> Tuple[float, float]:
+    mean = float(np.mean(values))
+    if len(values) < 2:
+        return mean, mean
+    delta = stats.t.ppf((1 + confidence) / 2, len(values) - 1) * stats.sem(values)
+    return mean - delta, mean + delta
+
+
+def elbow(ks: List[int], inertias: List[float]) -> int:
+    """The k farthest from the line between the first and the last point of the (normalized) inertia curve."""
+    x = (np.asarray(ks) - ks[0]) / max(ks[-1] - ks[0], 1)
+    y = (np.asarray(inertias) - inertias[-1]) / max(inertias[0] - inertias[-1], 1e-12)
+    return ks[int(np.argmax(1 - x - y))]
+
+
+def cluster_summary(labels: np.ndarray, sampled: np.ndarray, values: np.ndarray, centers: np.ndarray) -> pd.DataFrame:
+    """Summarize the silhouette of the ``sampled`` rows (their clusters) of each cluster.
 
+    ``rows`` is the number of rows of the cluster, ``sampled`` the number of its silhouettes.
+    """
+    k = len(centers)
+    silhouettes = pd.Series(values).groupby(sampled)
+    summary = silhouettes.quantile(SUMMARY_QUANTILES).unstack()
+    summary.columns = [f"q{round(q * 100):02d}" for q in SUMMARY_QUANTILES]
+    summary.insert(0, 'min', silhouettes.min())
+    summary['max'] = silhouettes.max()
+    summary.insert(0, 'mean', silhouettes.mean())
+    summary.insert(0, 'sampled', silhouettes.size())
+    summary = summary.reindex(range(k))
+    summary.insert(0, 'rows', np.bincount(labels, minlength=k))
+    summary['sampled'] = summary['sampled'].fillna(0).astype(int)
+    summary[["ClusterLongitude", "ClusterLatitude"]] = centers
+    return summary.rename_axis('cluster')
 
-def test_with_k_clusters(df: pd.DataFrame, k: int, seed: int = 42, outfolder: str = 'results'):
-    fig, (ax1, ax2) = plt.subplots(1, 2)
-    fig.set_size_inches(18, 7)
-    ax1.set_xlim([-1, 1])
-    ax1.set_ylim([0, df.shape[0] + (k + 1) * 10])
-
-    clusterer = KMeans(n_clusters=k, random_state=seed)
-    labels = clusterer.fit_predict(df)
-    silhouette_avg = silhouette_score(df, labels)
-
-    # Compute the silhouette scores for each sample
-    sample_silhouette_values = silhouette_samples(df, labels)
-    y_lower = 10
-    for i in range(k):
-        # Aggregate the silhouette scores for samples belonging to
-        # cluster i, and sort them
-        ith_cluster_silhouette_values = sample_silhouette_values[labels == i]
-
-        ith_cluster_silhouette_values.sort()
-
-        size_cluster_i = ith_cluster_silhouette_values.shape[0]
-        y_upper = y_lower + size_cluster_i
-
-        color = cm.nipy_spectral(float(i) / k)
-        ax1.fill_betweenx(
-            np.arange(y_lower, y_upper),
-            0,
-            ith_cluster_silhouette_values,
-            facecolor=color,
-            edgecolor=color,
-            alpha=0.7,
-        )
-
-        # Label the silhouette plots with their cluster numbers at the middle
-        ax1.text(-0.05, y_lower + 0.5 * size_cluster_i, str(i))
-
-        # Compute the new y_lower for next plot
-        y_lower = y_upper + 10  # 10 for the 0 samples
-
-    ax1.set_title("The silhouette plot for the various clusters.")
-    ax1.set_xlabel("The silhouette coefficient values")
-    ax1.set_ylabel("Cluster label")
-
-    # The vertical line for average silhouette score of all the values
-    ax1.axvline(x=silhouette_avg, color="red", linestyle="--")
-
-    ax1.set_yticks([])  # Clear the yaxis labels / ticks
-    ax1.set_xticks([-0.1, 0, 0.2, 0.4, 0.6, 0.8, 1])
-
-    # 2nd Plot showing the actual clusters formed
-    colors = cm.nipy_spectral(labels.astype(float) / k)
-    ax2.scatter(
-        df.iloc[:, 0], df.iloc[:, 1], marker="o", s=30, lw=0, alpha=0.7, c=colors, edgecolor="k"
-    )
-
-    # Labeling the clusters
-    centers = clusterer.cluster_centers_
-    # Draw white circles at cluster centers
-    ax2.scatter(
-        centers[:, 0],
-        centers[:, 1],
-        marker="o",
-        c="white",
-        alpha=1,
-        s=200,
-        edgecolor="k",
-    )
-
-    for i, c in enumerate(centers):
-        ax2.scatter(c[0], c[1], marker="$%d$" % i, alpha=1, s=50, edgecolor="k")
-
-    ax2.set_title("The visualization of the clustered data.")
-    ax2.set_xlabel("Feature space for the 1st feature")
-    ax2.set_ylabel("Feature space for the 2nd feature")
-
-    plt.suptitle(
-        "Silhouette analysis for KMeans clustering on sample data with n_clusters = %d"
-        % k,
-        fontsize=14,
-        fontweight="bold",
-    )
 
+def fitting_data(data: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """The rows the clusterings are fitted on (the distinct ``points``, if any) and their weights."""
+    if 'points' in data:
+        return data['points'], data['counts']
+    return data['coordinates'], np.ones(len(data['coordinates']))
+
+
+def fit_clustering(data: Dict[str, np.ndarray], k: int, seed: int = 42, init: np.ndarray = None) -> Fit:
+    """Fit a KMeans, from scratch or from the ``init`` centroids, and return its centroids and inertia."""
+    x, weights = fitting_data(data)
+    if init is None:
+        clusterer = KMeans(n_clusters=k, random_state=seed)
+    else:
+        clusterer = KMeans(n_clusters=k, init=init, n_init=1, random_state=seed)
+    clusterer.fit(x, sample_weight=weights)
+    return clusterer.cluster_centers_, float(clusterer.inertia_)
+
+
+def split_worst_cluster(data: Dict[str, np.ndarray], centers: np.ndarray, seed: int = 42) -> np.ndarray:
+    """Return ``centers`` with the cluster with the largest (weighted) sum of squared distances split in two."""
+    x, weights = fitting_data(data)
+    labels = ClusterAssigner(centers, cache_size=0).assign(x)
+    errors = np.bincount(labels, weights * ((x - centers[labels]) ** 2).sum(axis=1), minlength=len(centers))
+    worst = int(np.argmax(errors))
+    rows = labels == worst
+    halves = KMeans(n_clusters=2, n_init=1, random_state=seed).fit(x[rows], sample_weight=weights[rows])
+    return np.vstack([np.delete(centers, worst, axis=0), halves.cluster_centers_])
+
+
+def dataset_hash(**arrays: np.ndarray) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(arrays):
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(arrays[name]).tobytes())
+    return digest.hexdigest()
+
+
+def fit_path(fits: Path, k: int) -> Path:
+    return fits / f"{k:03d}-fit.npz"
+
+
+def load_fit(fits: Path, k: int) -> Optional[Fit]:
+    if not fit_path(fits, k).exists():
+        return None
+    with np.load(fit_path(fits, k)) as fit:
+        return fit['centers'], float(fit['inertia'])
+
+
+def save_fit(fits: Path, k: int, fit: Fit):
+    np.savez(fit_path(fits, k), centers=fit[0], inertia=fit[1])
+
+
+def warm_sweep(arrays: Dict[str, str], ks: List[int], fits: Path, seed: int = 42) -> Iterator[int]:
+    """Fit the clusterings with each of the (sorted) ``ks`` in ``fits``, each one starting from the previous one with
+    its worst cluster split (or from scratch, for the first one and after a gap in ``ks``), and yield each k as soon
+    as its clustering is there."""
+    data = load_arrays(arrays)
+    previous = None
+    for k in tqdm(ks):
+        fit = load_fit(fits, k)
+        if fit is None:
+            init = split_worst_cluster(data, previous[0], seed) if previous and len(previous[0]) == k - 1 else None
+            fit = fit_clustering(data, k, seed, init)
+            save_fit(fits, k, fit)
+        previous = fit
+        yield k
+
+
+def test_with_k_clusters(arrays: Dict[str, str], k: int, fits: str, seed: int = 42, outfolder: str = 'results',
+                         sample: int = 10_000, repeats: int = 5, working_memory: int = 256,
+                         plot_points: int = 10_000) -> dict:
+    """Evaluate the clustering of the shared ``coordinates`` in ``k`` clusters, fitting it (on the distinct
+    ``points`` weighted by their ``counts``, if given) unless it is already in ``fits``.
+
+    Besides returning the scores, the silhouette of each cluster is summarized in ``outfolder``, along with a sample
+    of ``plot_points`` rows to plot the clusters with ``plot-silhouette.py``. The evaluation is kept in ``fits``
+    too, and reused as long as its parameters don't change.
+    """
+    fits = Path(fits)
+    outputs = [f"{k:02d}-clusters.csv", f"{k:02d}-points.npz"]
     directory = Path(outfolder)
     directory.mkdir(parents=True, exist_ok=True)
-    plt.savefig(directory / f"{k:02d}-clusters.pdf")
-    plt.clf()
-    return k, silhouette_avg
+    parameters = {'sample': sample, 'repeats': repeats, 'plot-points': plot_points}
+    evaluation = fits / f"{k:03d}-evaluation.yaml"
+    if evaluation.exists() and all((fits / name).exists() for name in outputs):
+        with open(evaluation, 'r') as f:
+            cached = yaml.safe_load(f)
+        if cached['parameters'] == parameters:
+            for name in outputs:
+                shutil.copy(fits / name, directory / name)
+            return cached['result']
+
+    data = load_arrays(arrays)
+    coordinates = data['coordinates']
+    fit = load_fit(fits, k)
+    if fit is None:
+        fit = fit_clustering(data, k, seed)
+        save_fit(fits, k, fit)
+    centers, inertia = fit
+    labels = ClusterAssigner(centers, cache_size=0).assign(coordinates)
+
+    rng = np.random.default_rng([seed, k])
+    scores, sampled, values = [], [], []
+    with sklearn.config_context(working_memory=working_memory):
+        for _ in range(repeats):
+            rows = stratified_sample(labels, sample, rng)
+            values.append(silhouette_samples(coordinates[rows], labels[rows]))
+            sampled.append(labels[rows])
+            scores.append(values[-1].mean())
+    low, high = confidence_interval(scores)
+    result = {
+        'n_clusters': k,
+        'silhouette_score': float(np.mean(scores)),
+        'silhouette_low': float(low),
+        'silhouette_high': float(high),
+        'inertia': inertia,
+        'calinski_harabasz': float(calinski_harabasz_score(coordinates, labels)),
+    }
+
+    summary = cluster_summary(labels, np.concatenate(sampled), np.concatenate(values), centers)
+    summary.to_csv(fits / outputs[0])
+    rows = stratified_sample(labels, plot_points, rng)
+    np.savez_compressed(fits / outputs[1], coordinates=coordinates[rows], labels=labels[rows],
+                        silhouette_score=result['silhouette_score'])
+    for name in outputs:
+        shutil.copy(fits / name, directory / name)
+    with open(evaluation, 'w') as f:
+        yaml.safe_dump({'parameters': parameters, 'result': result}, f)
+    return result
 
 
 def main():
+    if Path("params.yaml").exists():
+        with open("params.yaml", "r") as f:
+            params = yaml.safe_load(f)
+    else:
+        params = {'clustering': {'bounds': BOUNDS}}
     parser = argparse.ArgumentParser()
     parser.add_argument('infile', nargs='+')
     parser.add_argument('--seed', '-s', default=42, type=int)
     parser.add_argument('--min', '-m', default=2, type=int)
     parser.add_argument('--max', '-M', default=20, type=int)
+    parser.add_argument('--dedup', '-d', action='store_true',
+                        help="Fit on the distinct coordinates, weighted by their number of rows")
+    parser.add_argument('--grid', '-g', type=float, default=None,
+                        help="Snap the coordinates to a grid of this many degrees (implies --dedup)")
+    parser.add_argument('--sweep', choices=SWEEPS, default='warm',
+                        help="Start each clustering from the one with a cluster less (warm), or from scratch")
+    parser.add_argument('--cache', '-c', default=None,
+                        help="Directory where the clusterings are kept, to be reused by the next runs")
+    parser.add_argument('--sample', '-n', default=10_000, type=int, help="Rows in each sample for the silhouette")
+    parser.add_argument('--repeats', '-r', default=5, type=int, help="Number of samples for the silhouette")
+    parser.add_argument('--working-memory', default=256, type=int,
+                        help="Memory (in MiB) for each block of pairwise distances")
+    parser.add_argument('--output', '-o', default='results',
+                        help="Directory of the scores, of the summaries of the clusters and of the points to plot")
+    parser.add_argument('--plot-points', default=10_000, type=int,
+                        help="Rows of each clustering saved for plot-silhouette.py")
+    parser.add_argument('--bounds', nargs=4, type=float, metavar=('LON_MIN', 'LON_MAX', 'LAT_MIN', 'LAT_MAX'),
+                        help="Range of the valid positions. Defaults to the one in params.yaml")
     args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    # The same rows as in clustering.py
+    bounds = params['clustering'].get('bounds', BOUNDS)
+    if args.bounds:
+        bounds = {'Longitude': tuple(args.bounds[:2]), 'Latitude': tuple(args.bounds[2:])}
 
-    load = partial(pd.read_csv, usecols=["Latitude", "Longitude"])
-
+    load = partial(read_table, columns=COORDINATES)
     df = pd.concat(map(load, args.infile), axis=0, ignore_index=True)
-    df = df[(df != 0).any(axis=1)]
+    validate = PositionValidator(bounds)
+    df = validate(df)
+    validate.report()
+    coordinates = df[COORDINATES].to_numpy()
+    arrays = {}
+    if args.dedup or args.grid:
+        points, counts, inverse = dedup_coordinates(coordinates, args.grid)
+        arrays = {'points': points, 'counts': counts}
+        if args.grid:
+            # The snapped coordinates are the ones clustered and plotted
+            coordinates = points[inverse]
+    del df
+    ks = list(range(args.min, args.max + 1))
 
-    test_k_on_dataset = partial(test_with_k_clusters, df, seed=args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        key = f"{dataset_hash(coordinates=coordinates, **arrays)}-{args.seed}-{args.sweep}"
+        if args.sweep == 'warm':
+            # A warm sweep depends on where it starts
+            key += f"-from-{args.min}"
+        fits = Path(args.cache or directory) / key
+        fits.mkdir(parents=True, exist_ok=True)
+        shared = share_arrays(Path(directory), coordinates=coordinates, **arrays)
+        del coordinates, arrays
+        test_k_on_dataset = partial(test_with_k_clusters, shared, fits=str(fits), seed=args.seed,
+                                    outfolder=args.output, sample=args.sample, repeats=args.repeats,
+                                    working_memory=args.working_memory, plot_points=args.plot_points)
+        if args.sweep == 'warm':
+            # Each clustering is evaluated by the workers as soon as it is fitted, while the sweep goes on
+            with ProcessPoolExecutor() as executor:
+                futures = [executor.submit(test_k_on_dataset, k) for k in warm_sweep(shared, ks, fits, args.seed)]
+                res = [future.result() for future in futures]
+        else:
+            res = p_umap(test_k_on_dataset, ks)
+        res = sorted(res, key=lambda x: x['n_clusters'])
 
-    res = p_umap(test_k_on_dataset, list(range(args.min, args.max + 1)))
-    print("n_clusters,silhouette_score")
-    print("\n".join(map(lambda x: f"{x[0]},{x[1]}", sorted(res, key=lambda x: x[0]))))
+    if len(res) > 2:
+        ks, inertias = [x['n_clusters'] for x in res], [x['inertia'] for x in res]
+        logging.info("Elbow of the inertia at k = %d", elbow(ks, inertias))
+    scores = pd.DataFrame(res, columns=RESULT_COLS)
+    scores.to_csv(Path(args.output) / SCORES_NAME, index=False)
+    print(scores.to_csv(index=False), end='')
 
 
 if __name__ == '__main__':
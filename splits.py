@@ -0,0 +1,232 @@
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Reading the training and testing sets of the splits created by ``create-train-test*.py``.
+
+A set is either a file in the split (e.g. ``train.csv``) or, for the virtual splits, only listed in the manifest of
+the split (``contained-windows.yaml``): the windows it is made of are then read from the shared windows directory, and
+the projection in the manifest (the dropped columns, the index and the constant columns added to them) is applied on
+the fly. Either way the rows are the same.
+
+A derived split (e.g. a resized one) is a projection of another split: its manifest points to the source split, and
+its sets, unless they have been written as files, are read from the source with the projection applied, reading only
+the columns that are kept.
+"""
+
+import os
+import shutil
+import sys
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Callable, Iterator, List, Set, Union
+
+import pandas as pd
+import yaml
+
+from tableio import EXTENSIONS, STDIO, Columns, TableWriter, detect_format, read_chunks, read_columns
+from windowstore import is_store, iter_windows, read_index, window_path
+
+MANIFEST_NAME = 'contained-windows.yaml'
+DEFAULT_CHUNKSIZE = 100_000
+# The seconds per byte of window (measured on the synthetic feeds) taken to copy a CSV window as it is, to read or
+# write a window with pandas, and to perturb a testing window, to estimate the cost of creating each split
+COPY_COST = 2e-9
+TABLE_COST = 1e-7
+PERTURB_COST = 1.5e-6
+# The memory taken by a window read with pandas, per byte of its file, and the one of a worker before it reads anything
+MEMORY_FACTOR = 10
+WORKER_MEMORY = 100 * 2 ** 20
+# The keys of the manifests that only describe the training set, and the ones that describe both the sets
+TRAINING_KEYS = ['training-windows', 'training-signatures', 'windows-directory', 'training-window-ids', 'projection']
+SHARED_KEYS = ['format', 'dropped-columns']
+
+
+def read_manifest(split: Union[str, Path]) -> dict:
+    # A set is read through several manifests, so the C loader (if libyaml is there) is used when it can
+    with open(Path(split) / MANIFEST_NAME, 'r') as f:
+        return yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+def virtual_manifest(folder: Path, directory: Path, windows: List[int], projection: dict = None) -> dict:
+    """The keys of the manifest of a split (in ``folder``) whose training set are ``windows`` of ``directory``."""
+    manifest = {
+        'windows-directory': os.path.relpath(directory, folder),
+        'training-window-ids': [int(x) for x in windows],
+    }
+    if projection:
+        manifest['projection'] = projection
+    return manifest
+
+
+def derived_manifest(folder: Path, source: Path, projection: dict, fmt: str = 'csv') -> dict:
+    """The manifest of a split (in ``folder``) whose sets are the ones of the split ``source`` after ``projection``."""
+    return {
+        'source-split': os.path.relpath(source, folder),
+        'projection': projection,
+        'format': fmt,
+    }
+
+
+def stale_sets(folder: Path, manifest: dict) -> Set[str]:
+    """Return the sets (``train`` and ``test``) of the split in ``folder`` that don't match ``manifest``.
+
+    A set is stale if its file is missing, or if the manifest written when it was created (if any) differs from the
+    given one in the keys that describe that set.
+    """
+    if not (folder / MANIFEST_NAME).exists():
+        return {'train', 'test'}
+    previous = read_manifest(folder)
+    keys = set(previous) | set(manifest)
+    stale = set()
+    if any(previous.get(key) != manifest.get(key) for key in TRAINING_KEYS + SHARED_KEYS):
+        stale.add('train')
+    elif 'training-window-ids' not in manifest and not set_path(folder, 'train', manifest).exists():
+        stale.add('train')
+    if any(previous.get(key) != manifest.get(key) for key in keys - set(TRAINING_KEYS)):
+        stale.add('test')
+    elif not set_path(folder, 'test', manifest).exists():
+        stale.add('test')
+    return stale
+
+
+def remove_splits(output: Path, keep: int):
+    """Remove the splits in ``output`` numbered from ``keep`` on, e.g. after some windows have been removed."""
+    for folder in output.glob('split-*'):
+        if int(folder.name[6:]) >= keep:
+            shutil.rmtree(folder)
+
+
+def set_path(split: Union[str, Path], name: str = 'train', manifest: dict = None) -> Path:
+    manifest = manifest if manifest is not None else read_manifest(split)
+    return Path(split) / f"{name}{EXTENSIONS[manifest.get('format', 'csv')]}"
+
+
+def is_virtual(split: Union[str, Path], name: str = 'train') -> bool:
+    return not set_path(split, name).exists()
+
+
+def project(df: pd.DataFrame, projection: dict) -> pd.DataFrame:
+    """Apply to some rows the ``projection`` of a manifest (the dropped columns are expected to be already left out)."""
+    if projection.get('index-label'):
+        df = df.rename_axis(projection['index-label']).reset_index()
+    for col, value in projection.get('constants', {}).items():
+        df[col] = value
+    return df
+
+
+def _source_columns(split: Path, name: str, manifest: dict) -> List[str]:
+    """The columns of the source (the windows or the source split) of a set that isn't a file."""
+    if 'source-split' in manifest:
+        return set_columns(split / manifest['source-split'], name)
+    directory = split / manifest['windows-directory']
+    if is_store(directory):
+        return read_columns(directory / read_index(directory)['file'])
+    windows = manifest['training-window-ids']
+    return read_columns(window_path(directory, windows[0], manifest.get('format', 'csv'))) if windows else []
+
+
+def set_columns(split: Union[str, Path], name: str = 'train') -> List[str]:
+    """Return the names of the columns of the set ``name`` of a split, without reading it."""
+    split = Path(split)
+    manifest = read_manifest(split)
+    path = set_path(split, name, manifest)
+    if path.exists():
+        return read_columns(path)
+    projection = manifest.get('projection', {})
+    drop = tuple(projection.get('drop', ()))
+    columns = [col for col in _source_columns(split, name, manifest) if not col.startswith(drop)]
+    if projection.get('index-label'):
+        columns.insert(0, projection['index-label'])
+    return columns + [col for col in projection.get('constants', {}) if col not in columns]
+
+
+def _projected(chunks: Iterator[pd.DataFrame], projection: dict,
+               wanted: Callable[[str], bool]) -> Iterator[pd.DataFrame]:
+    start = 0
+    for df in chunks:
+        df = project(df, projection)
+        df.index = pd.RangeIndex(start, start + len(df))
+        start += len(df)
+        kept = [col for col in df.columns if wanted(col)]
+        # Selecting the columns copies the chunk, so it isn't done when all of them are kept
+        yield df if len(kept) == len(df.columns) else df[kept]
+
+
+def split_chunks(split: Union[str, Path], name: str = 'train', columns: Columns = None,
+                 chunksize: int = DEFAULT_CHUNKSIZE) -> Iterator[pd.DataFrame]:
+    """Yield the rows of the set ``name`` (``train`` or ``test``) of a split, in chunks indexed by the position of
+    their rows in the set.
+
+    The chunks of a virtual set are its windows, the ones of a derived set are the chunks of its source.
+    """
+    split = Path(split)
+    manifest = read_manifest(split)
+    path = set_path(split, name, manifest)
+    if path.exists():
+        yield from read_chunks(path, chunksize, columns=columns)
+        return
+    if 'source-split' not in manifest and (name != 'train' or 'training-window-ids' not in manifest):
+        raise FileNotFoundError(f"{path} doesn't exist and it isn't listed in {split / MANIFEST_NAME}")
+
+    projection = manifest.get('projection', {})
+    drop = tuple(projection.get('drop', ()))
+
+    def wanted(col: str) -> bool:
+        if columns is None:
+            return True
+        return columns(col) if callable(columns) else col in columns
+
+    kept = [col for col in _source_columns(split, name, manifest) if not col.startswith(drop)]
+    # At least a column is read, or the rows would be lost
+    kept = [col for col in kept if wanted(col)] or kept[:1]
+
+    if 'source-split' in manifest:
+        chunks = split_chunks(split / manifest['source-split'], name, columns=kept, chunksize=chunksize)
+    else:
+        directory = split / manifest['windows-directory']
+        windows = iter_windows(directory, manifest['training-window-ids'], fmt=manifest.get('format', 'csv'),
+                               columns=kept)
+        chunks = (df for _, df in windows)
+    yield from _projected(chunks, projection, wanted)
+
+
+def read_split(split: Union[str, Path], name: str = 'train', columns: Columns = None) -> pd.DataFrame:
+    return pd.concat(split_chunks(split, name, columns=columns), ignore_index=True)
+
+
+def export_split(split: Union[str, Path], output: Union[str, Path], name: str = 'train', fmt: str = None):
+    """Write the set ``name`` of a split to ``output`` (e.g. to give a virtual training set to a tool as a file).
+
+    Unprojected CSV windows are copied as they are, without parsing them.
+    """
+    split = Path(split)
+    manifest = read_manifest(split)
+    fmt = fmt or detect_format(output)
+    directory = split / manifest.get('windows-directory', '.')
+    copy = name == 'train' and is_virtual(split, name) and 'training-window-ids' in manifest
+    copy = copy and not manifest.get('projection') and not is_store(directory)
+    if copy and fmt == 'csv' and manifest.get('format', 'csv') == 'csv':
+        with (open(output, 'wb') if str(output) != STDIO else nullcontext(sys.stdout.buffer)) as dest:
+            for j, window in enumerate(manifest['training-window-ids']):
+                with open(window_path(directory, window), 'rb') as source:
+                    # Skip the header if it is not the first file
+                    if j != 0:
+                        next(source)
+                    shutil.copyfileobj(source, dest)
+        return
+
+    with TableWriter(output, fmt=fmt) as writer:
+        for chunk in split_chunks(split, name):
+            writer.write(chunk)
@@ -0,0 +1,291 @@
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Reading and writing the datasets exchanged by the stages, either as CSV or in a columnar format.
+
+The format of a file is given by its extension (anything unknown is CSV), and "-" stands for stdin/stdout (CSV only).
+The CSV specific arguments of the readers and writers (e.g. ``dtype`` or ``parse_dates``) are ignored for the columnar
+formats, as these store the types of the columns.
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Iterator, List, Tuple, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+FORMATS = ['csv', 'parquet', 'feather']
+EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+STDIO = '-'
+# Size of the buffer of the CSV files being written
+BUFFER_SIZE = 1024 * 1024
+
+Columns = Union[List[str], Callable[[str], bool], None]
+# A piece of a file that can be read on its own: the rows of a CSV that start in a range of bytes, or a part of a
+# columnar file
+Piece = Union[Tuple[int, int], int]
+# A chunk ready to be written (see ``encode_chunk``)
+EncodedChunk = Union[Tuple[str, str], pa.Table]
+
+
+def add_format_argument(parser: argparse.ArgumentParser,
+                        description: str = "Format of the output. Defaults to the one of its extension",
+                        default: str = None):
+    parser.add_argument('--format', choices=FORMATS, default=default, help=description)
+
+
+def detect_format(path: Union[str, Path]) -> str:
+    suffixes = {extension: fmt for fmt, extension in EXTENSIONS.items()}
+    return suffixes.get(Path(path).suffix, 'csv') if str(path) != STDIO else 'csv'
+
+
+@lru_cache(maxsize=1024)
+def _csv_header(path: str, size: int, mtime: int) -> Tuple[str, ...]:
+    # The size and the time of the last change are part of the key, so that a file written again is read again
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        return tuple(next(csv.reader(f), []))
+
+
+def read_columns(path: Union[str, Path]) -> List[str]:
+    """Return the names of the columns of a file, without reading it."""
+    fmt = detect_format(path)
+    if fmt == 'parquet':
+        return pq.read_schema(path).names
+    if fmt == 'feather':
+        return pa.ipc.open_file(pa.memory_map(str(path))).schema.names
+    # Only the first line is parsed: read_csv(nrows=0) takes a lot longer on the wide windows
+    stat = os.stat(path)
+    return list(_csv_header(str(path), stat.st_size, stat.st_mtime_ns))
+
+
+def _select(path: Union[str, Path], columns: Columns) -> List[str]:
+    return [col for col in read_columns(path) if columns(col)] if callable(columns) else columns
+
+
+def read_table(path: Union[str, Path], columns: Columns = None, **csv_kwargs) -> pd.DataFrame:
+    """Read the ``columns`` (a list or a filter on the names) of a file."""
+    fmt = detect_format(path)
+    if fmt == 'csv':
+        return pd.read_csv(sys.stdin if str(path) == STDIO else path, usecols=columns, **csv_kwargs)
+    if fmt == 'parquet':
+        return pd.read_parquet(path, columns=_select(path, columns))
+    return pd.read_feather(path, columns=_select(path, columns))
+
+
+def read_chunks(path: Union[str, Path], chunksize: int, columns: Columns = None,
+                **csv_kwargs) -> Iterator[pd.DataFrame]:
+    """Read a file in chunks of (at most) ``chunksize`` rows, indexed by their position in the file."""
+    fmt = detect_format(path)
+    if fmt == 'csv':
+        with pd.read_csv(sys.stdin if str(path) == STDIO else path, usecols=columns, chunksize=chunksize,
+                         **csv_kwargs) as reader:
+            yield from reader
+        return
+
+    columns = _select(path, columns)
+    if fmt == 'parquet':
+        batches = pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns)
+    else:
+        reader = pa.ipc.open_file(pa.memory_map(str(path)))
+        tables = (pa.Table.from_batches([reader.get_batch(i)]) for i in range(reader.num_record_batches))
+        tables = (table.select(columns) if columns is not None else table for table in tables)
+        batches = (table.slice(start, chunksize) for table in tables for start in range(0, len(table), chunksize))
+    start = 0
+    for batch in batches:
+        df = batch.to_pandas()
+        df.index = pd.RangeIndex(start, start + len(df))
+        start += len(df)
+        yield df
+
+
+def read_parts(path: Union[str, Path], parts: List[int], columns: Columns = None) -> pd.DataFrame:
+    """Read the ``parts`` (the row groups of a Parquet file, or the record batches of a Feather one) of a file.
+
+    A columnar ``TableWriter`` writes each chunk as a new part, and counts them in ``TableWriter.parts``.
+    """
+    fmt = detect_format(path)
+    if fmt == 'csv':
+        raise ValueError("Only the columnar formats can be read by parts")
+    columns = _select(path, columns)
+    if fmt == 'parquet':
+        return pq.ParquetFile(path).read_row_groups(parts, columns=columns).to_pandas()
+    reader = pa.ipc.open_file(pa.memory_map(str(path)))
+    table = pa.Table.from_batches([reader.get_batch(i) for i in parts], schema=reader.schema)
+    return (table.select(columns) if columns is not None else table).to_pandas()
+
+
+def read_lines(path: Union[str, Path], start: int, end: int) -> bytes:
+    """Return the lines of a file that start between the bytes ``start`` (after the first byte, e.g. after the header)
+    and ``end``.
+
+    Cutting a file in consecutive ranges gives every line to exactly one of them. The last line always ends with a
+    newline.
+    """
+    with open(path, 'rb') as f:
+        # Skip the line that starts before the range (none if the previous byte ends a line)
+        f.seek(start - 1)
+        f.readline()
+        data = f.read(max(end - f.tell(), 0))
+        if data and not data.endswith(b'\n'):
+            data += f.readline()
+    if data and not data.endswith(b'\n'):
+        data += b'\n'
+    return data
+
+
+def byte_ranges(path: Union[str, Path], size: int) -> List[Tuple[int, int]]:
+    """Cut the rows of a CSV file (after its header) into ranges of about ``size`` bytes, see ``read_lines``."""
+    with open(path, 'rb') as f:
+        header = len(f.readline())
+    total = Path(path).stat().st_size
+    return [(start, min(start + size, total)) for start in range(header, total, size)]
+
+
+def split_file(path: Union[str, Path], chunksize: int) -> List[Piece]:
+    """Cut a file into pieces that can be read independently (e.g. by different processes) with ``read_piece``.
+
+    A CSV file is cut into ranges of bytes of about ``chunksize`` rows (from the length of its first lines), a
+    columnar one into its parts.
+    """
+    fmt = detect_format(path)
+    if fmt == 'parquet':
+        return list(range(pq.ParquetFile(path).num_row_groups))
+    if fmt == 'feather':
+        return list(range(pa.ipc.open_file(pa.memory_map(str(path))).num_record_batches))
+    with open(path, 'rb') as f:
+        f.readline()
+        sample = f.readlines(BUFFER_SIZE)
+    line = sum(map(len, sample)) / len(sample) if sample else 1
+    return byte_ranges(path, max(int(chunksize * line), 1))
+
+
+def read_piece(path: Union[str, Path], piece: Piece, columns: Columns = None, **csv_kwargs) -> pd.DataFrame:
+    """Read a piece of a file (see ``split_file``), as a chunk of ``read_chunks`` would be read."""
+    if detect_format(path) != 'csv':
+        return read_parts(path, [piece], columns=columns)
+    with open(path, 'rb') as f:
+        header = f.readline()
+    return pd.read_csv(io.BytesIO(header + read_lines(path, *piece)), usecols=columns, **csv_kwargs)
+
+
+def encode_chunk(df: pd.DataFrame, fmt: str = 'csv', index: bool = False, index_label: str = None,
+                 **csv_kwargs) -> EncodedChunk:
+    """Turn a chunk into what a ``TableWriter`` with the same arguments writes: the header and the rows of the CSV
+    text, or an Arrow table."""
+    if fmt == 'csv':
+        header, rows = df.to_csv(index=index, index_label=index_label, **csv_kwargs).split('\n', 1)
+        return header + '\n', rows
+    if index:
+        df = (df.rename_axis(index_label) if index_label else df).reset_index()
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+class TableWriter:
+    """Write a table a chunk at a time.
+
+    The index is written only if ``index`` is set: as the first columns of the CSV, as it would be by
+    ``DataFrame.to_csv``, or as regular columns in the columnar formats, where each chunk becomes a part of the file
+    (see ``read_parts``). With ``append`` the rows are added to the ones already in the file (if any): CSV files are
+    just appended to, while the columnar ones are rewritten.
+    """
+
+    def __init__(self, path: Union[str, Path], fmt: str = None, index: bool = False, index_label: str = None,
+                 append: bool = False, **csv_kwargs):
+        self.path = path
+        self.fmt = fmt or detect_format(path)
+        self.index = index
+        self.index_label = index_label
+        self.append = append and str(path) != STDIO and Path(path).exists()
+        self.csv_kwargs = csv_kwargs
+        self._file = None
+        self._writer = None
+        self._schema = None
+        self.parts = 0
+        if self.fmt != 'csv' and str(path) == STDIO:
+            raise ValueError(f"The {self.fmt} format can't be written to stdout")
+
+    def _open_csv(self) -> bool:
+        """Open the CSV file, if it isn't yet, and return whether the header has to be written."""
+        header = self._file is None and not self.append
+        if self._file is None:
+            if str(self.path) == STDIO:
+                self._file = sys.stdout
+            else:
+                self._file = open(self.path, 'a' if self.append else 'w', buffering=BUFFER_SIZE)
+        return header
+
+    def write(self, df: pd.DataFrame):
+        if self.fmt == 'csv':
+            header = self._open_csv()
+            df.to_csv(self._file, header=header, index=self.index, index_label=self.index_label, **self.csv_kwargs)
+            return
+        self.write_encoded(encode_chunk(df, self.fmt, index=self.index, index_label=self.index_label))
+
+    def write_encoded(self, chunk: EncodedChunk):
+        """Write a chunk encoded by ``encode_chunk`` with the same arguments as this writer (e.g. by a worker)."""
+        if self.fmt == 'csv':
+            header, rows = chunk
+            if self._open_csv():
+                self._file.write(header)
+            self._file.write(rows)
+            return
+
+        table = chunk
+        if self._writer is None:
+            previous = None
+            if self.append:
+                # Read in memory, as the file is about to be overwritten
+                with pa.OSFile(str(self.path)) as f:
+                    previous = pq.read_table(f) if self.fmt == 'parquet' else pa.ipc.open_file(f).read_all()
+            self._schema = previous.schema if previous is not None else table.schema
+            if self.fmt == 'parquet':
+                self._writer = pq.ParquetWriter(self.path, self._schema)
+            else:
+                options = pa.ipc.IpcWriteOptions(compression='lz4')
+                self._writer = pa.ipc.new_file(str(self.path), self._schema, options=options)
+            if previous is not None:
+                self._writer.write_table(previous)
+        if table.num_rows == 0:
+            return
+        table = table.cast(self._schema).combine_chunks()
+        if self.fmt == 'parquet':
+            self._writer.write_table(table, row_group_size=table.num_rows)
+        else:
+            self._writer.write_batch(table.to_batches()[0])
+        self.parts += 1
+
+    def close(self):
+        if self._file is not None and self._file is not sys.stdout:
+            self._file.close()
+        if self._writer is not None:
+            self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def write_table(df: pd.DataFrame, path: Union[str, Path], fmt: str = None, **kwargs):
+    with TableWriter(path, fmt=fmt, **kwargs) as writer:
+        writer.write(df)
@@ -16,33 +16,93 @@
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
-import sys
-from math import floor
+from collections import OrderedDict
 from pathlib import Path
 
 import pandas as pd
 
+from instrumentation import add_metrics_arguments, instrumented, phase, timed_chunks
+from tableio import EXTENSIONS, STDIO, TableWriter, add_format_argument, detect_format, read_chunks
+from windowstore import WindowStoreWriter
+
+DEFAULT_CHUNKSIZE = 100_000
+DEFAULT_MAX_OPEN = 64
+
 
 def setup_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
-    parser.add_argument('infile', nargs='?', type=argparse.FileType('r'), default=sys.stdin)
+    parser.add_argument('infile', nargs='?', default=STDIO)
     parser.add_argument('--output', '-o', help="Output directory", default='.')
+    add_format_argument(parser, "Format of the windows. Defaults to the one of the input")
+    parser.add_argument('--chunksize', '-c', type=int, default=DEFAULT_CHUNKSIZE, help="Rows read at a time")
+    parser.add_argument('--max-open', type=int, default=DEFAULT_MAX_OPEN,
+                        help="Maximum number of window files kept open at once")
+    parser.add_argument('--single-file', action='store_true',
+                        help="Write all the windows in a single indexed file (only for the columnar formats)")
+    add_metrics_arguments(parser)
     return parser.parse_args()
 
 
-def process(chunk: pd.DataFrame, basedir='windows'):
-    base = Path(basedir)
-    base.mkdir(exist_ok=True, parents=True)
-    grouper = chunk['TimeWindowID'].map(lambda x: floor(x / 60))
-    for name, grp in chunk.groupby(grouper):
-        filename = base / f"window-{name}.csv"
-        grp.to_csv(filename, mode='a', header=(not filename.exists()), index=False)
+def window_hours(chunk: pd.DataFrame) -> pd.Series:
+    # TimeWindowID is in minutes
+    return chunk['TimeWindowID'] // 60
+
+
+class WindowWriters:
+    """The writers of the window files, of which only the ``max_open`` most recently used are kept open.
+
+    A window whose writer has been closed is appended to when it is written again, without repeating the header.
+    """
+
+    def __init__(self, basedir: Path, fmt: str = 'csv', max_open: int = DEFAULT_MAX_OPEN):
+        self.base = Path(basedir)
+        self.base.mkdir(exist_ok=True, parents=True)
+        self.fmt = fmt
+        self.max_open = max_open
+        self._open = OrderedDict()
+        self._written = set()
+
+    def write(self, window: int, df: pd.DataFrame):
+        writer = self._open.pop(window, None)
+        if writer is None:
+            if len(self._open) >= self.max_open:
+                self._open.popitem(last=False)[1].close()
+            writer = TableWriter(self.base / f"window-{window}{EXTENSIONS[self.fmt]}", fmt=self.fmt,
+                                 append=window in self._written)
+            self._written.add(window)
+        self._open[window] = writer
+        writer.write(df)
+
+    def close(self):
+        for writer in self._open.values():
+            writer.close()
+        self._open.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def process(chunk: pd.DataFrame, writers):
+    with phase('group', rows=len(chunk)):
+        groups = list(chunk.groupby(window_hours(chunk)))
+    with phase('write', rows=len(chunk)):
+        for name, grp in groups:
+            writers.write(name, grp)
 
 
 def main():
     args = setup_args()
-    with pd.read_csv(args.infile, parse_dates=["dateTimeGroup"], chunksize=100) as reader:
-        list(map(lambda x: process(x, basedir=args.output), reader))
+    fmt = args.format or detect_format(args.infile)
+    if args.single_file:
+        writers = WindowStoreWriter(args.output, fmt=fmt)
+    else:
+        writers = WindowWriters(args.output, fmt=fmt, max_open=args.max_open)
+    with instrumented('time-windows', args.metrics, args.profile), writers:
+        for chunk in timed_chunks('read', read_chunks(args.infile, args.chunksize, parse_dates=["dateTimeGroup"])):
+            process(chunk, writers)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,168 @@
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Schema of the Oslo transports dataset and vectorized parsers for its columns.
+
+The parsers work on the distinct values of a column (delays and aimed times repeat a lot, as every vehicle reports
+them many times) and then broadcast the result back to the rows.
+"""
+
+import logging
+from collections import Counter
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.api.extensions import take
+from pandas.api.types import is_datetime64_dtype, is_numeric_dtype
+
+# The types that pandas can't infer from the CSV
+DTYPES = {
+    'HeadwayService': "boolean",
+    "InCongestion": 'boolean',
+    'InPanic': 'boolean',
+    'monitoredCall/VehicleAtStop': 'boolean'
+}
+# ISO 8601 timestamps with an UTC offset, used in local time
+LOCAL_TIME_COLS = ["OriginAimedDepartureTime", "DestinationAimedArrivalTime"]
+# The types of the columns of the raw dataset, once parsed (e.g. when stored in a columnar format). Delay is in seconds.
+SCHEMA = {
+    'dateTime': 'datetime64[ns]',
+    'LinkDistance': 'Int64',
+    'Percentage': 'float64',
+    'LineRef': 'string',
+    'DirectionRef': 'Int64',
+    'PublishedLineName': 'string',
+    'OriginRef': 'string',
+    'OriginName': 'string',
+    'DestinationRef': 'string',
+    'DestinationName': 'string',
+    'OriginAimedDepartureTime': 'datetime64[ns]',
+    'DestinationAimedArrivalTime': 'datetime64[ns]',
+    'VehicleRef': 'float64',
+    'Delay': 'Int64',
+    'HeadwayService': 'boolean',
+    'InCongestion': 'boolean',
+    'InPanic': 'boolean',
+    'Longitude': 'float64',
+    'Latitude': 'float64',
+    'monitoredCall/StopPointRef': 'string',
+    'monitoredCall/VisitNumber': 'float64',
+    'monitoredCall/StopPointName': 'string',
+    'monitoredCall/VehicleAtStop': 'boolean',
+    'monitoredCall/DestinationDisplay': 'string',
+}
+WINDOW_FREQ = '5T'
+# Where the vehicles can be (Oslo and the former Akershus), in degrees. A failed GPS fix reports 0, 0
+BOUNDS = {'Longitude': (9.8, 11.9), 'Latitude': (59.4, 60.6)}
+
+Bounds = Dict[str, Tuple[float, float]]
+
+DELAY_RE = r"^(-?)PT(\d+)S$"
+UTC_OFFSET_RE = r"(?:Z|[+-]\d\d:?\d\d)$"
+
+
+def parse_unique(col: pd.Series, parser: Callable[[pd.Series], pd.Series]) -> pd.Series:
+    """Apply ``parser`` to the distinct values of ``col`` only, and spread the result to all of its rows."""
+    codes, uniques = pd.factorize(col)
+    parsed = parser(pd.Series(uniques)).to_numpy()
+    return pd.Series(take(parsed, codes, allow_fill=(codes < 0).any()), index=col.index, name=col.name)
+
+
+def parse_delay(col: pd.Series) -> pd.Series:
+    """Convert ISO 8601 durations in seconds (e.g. ``-PT123S``) to integer seconds.
+
+    Columns that have already been parsed are returned as they are.
+    """
+    if is_numeric_dtype(col.dtype):
+        return col
+
+    def parser(values: pd.Series) -> pd.Series:
+        parts = values.str.extract(DELAY_RE)
+        invalid = parts[1].isnull()
+        if invalid.any():
+            raise ValueError(f"Invalid delays: {', '.join(map(str, values[invalid].head()))}")
+        return pd.to_numeric(parts[0] + parts[1])
+
+    return parse_unique(col, parser)
+
+
+def parse_local_time(col: pd.Series) -> pd.Series:
+    """Convert timestamps with an UTC offset to naive ones, keeping the local time.
+
+    The offset is dropped from the text before parsing, so timestamps with different offsets (e.g. across a DST
+    change) are parsed in one go. Columns that have already been parsed are just made naive.
+    """
+    if isinstance(col.dtype, pd.DatetimeTZDtype):
+        return col.dt.tz_localize(None)
+    if is_datetime64_dtype(col.dtype):
+        return col
+    return parse_unique(col, lambda values: pd.to_datetime(values.str.replace(UTC_OFFSET_RE, '', regex=True)))
+
+
+def floor_window(col: pd.Series, freq: str = WINDOW_FREQ) -> pd.Series:
+    """Floor timestamps to the start of their time window."""
+    return col.dt.floor(freq)
+
+
+def apply_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """Parse the columns of a raw dataset read from CSV into the types of SCHEMA."""
+    df = df.copy()
+    for col in df.columns.intersection(SCHEMA.keys()):
+        if col == 'Delay':
+            df[col] = parse_delay(df[col])
+        elif col in LOCAL_TIME_COLS:
+            df[col] = parse_local_time(df[col])
+        elif col == 'dateTime':
+            df[col] = pd.to_datetime(df[col])
+        df[col] = df[col].astype(SCHEMA[col])
+    return df
+
+
+class PositionValidator:
+    """Drop the rows of chunks of a dataset whose position is missing or out of ``bounds`` (the range of each
+    coordinate column), and count them by reason.
+
+    Only the coordinate columns are checked, so it works both on the full rows and on the coordinates alone.
+    """
+
+    def __init__(self, bounds: Bounds = None):
+        self.bounds = bounds or BOUNDS
+        self.rows = 0
+        self.rejected = Counter()
+
+    def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
+        missing = np.zeros(len(df), dtype=bool)
+        zero = np.ones(len(df), dtype=bool)
+        outside = np.zeros(len(df), dtype=bool)
+        for col, (low, high) in self.bounds.items():
+            values = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+            missing |= np.isnan(values)
+            zero &= values == 0
+            outside |= ~((values >= low) & (values <= high))
+        outside &= ~(missing | zero)
+        self.rows += len(df)
+        self.rejected.update({
+            'missing': int(missing.sum()),
+            'zero': int(zero.sum()),
+            'out-of-bounds': int(outside.sum()),
+        })
+        invalid = missing | zero | outside
+        return df[~invalid] if invalid.any() else df
+
+    def report(self):
+        total = sum(self.rejected.values())
+        logging.info("Rejected %d of %d rows: %s", total, self.rows,
+                     ", ".join(f"{count} {reason}" for reason, count in self.rejected.items()) or "none")
@@ -0,0 +1,169 @@
+#  Copyright (C) 2022 Esposito Andrea and Montanaro Graziano
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""All the time windows in a single columnar file, with an index of where each of them is.
+
+The windows are written as parts of the file (see ``tableio.read_parts``), each holding rows of a single window, and
+the index (a YAML file next to it) lists the parts of each window, so that any of them can be read without scanning
+the others. The functions at the end read the windows written by ``time-windows.py`` in either layout: a store or a
+``window-N`` file per window.
+"""
+
+import hashlib
+from collections import defaultdict
+from pathlib import Path
+from typing import Iterable, Iterator, List, Tuple, Union
+
+import pandas as pd
+import yaml
+
+from tableio import EXTENSIONS, Columns, TableWriter, detect_format, read_parts, read_table
+
+STORE_NAME = 'windows'
+INDEX_NAME = 'windows.yaml'
+
+
+class WindowStoreWriter:
+    def __init__(self, directory: Union[str, Path], fmt: str = 'parquet'):
+        if fmt == 'csv':
+            raise ValueError("The windows can be stored in a single file only in a columnar format")
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True, parents=True)
+        self.path = self.directory / f"{STORE_NAME}{EXTENSIONS[fmt]}"
+        self._writer = TableWriter(self.path, fmt=fmt)
+        self._parts = defaultdict(list)
+        self._rows = defaultdict(int)
+
+    def write(self, window: int, df: pd.DataFrame):
+        if df.empty:
+            return
+        self._parts[int(window)].append(self._writer.parts)
+        self._rows[int(window)] += len(df)
+        self._writer.write(df)
+
+    def close(self):
+        self._writer.close()
+        with open(self.directory / INDEX_NAME, 'w') as f:
+            yaml.safe_dump({
+                'file': self.path.name,
+                'windows': {window: {'parts': self._parts[window], 'rows': self._rows[window]}
+                            for window in sorted(self._parts)}
+            }, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_index(directory: Union[str, Path]) -> dict:
+    with open(Path(directory) / INDEX_NAME, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def window_ids(directory: Union[str, Path]) -> List[int]:
+    return sorted(read_index(directory)['windows'])
+
+
+def read_windows(directory: Union[str, Path], windows: Iterable[int], columns: Columns = None) -> pd.DataFrame:
+    """Read the rows of the given windows of the store in ``directory``, in the order in which they were written."""
+    index = read_index(directory)
+    parts = sorted(part for window in windows for part in index['windows'][window]['parts'])
+    return read_parts(Path(directory) / index['file'], parts, columns=columns)
+
+
+def is_store(directory: Union[str, Path]) -> bool:
+    return (Path(directory) / INDEX_NAME).exists()
+
+
+def window_path(directory: Union[str, Path], window: int, fmt: str = 'csv') -> Path:
+    return Path(directory) / f"window-{window}{EXTENSIONS[fmt]}"
+
+
+def window_name(directory: Union[str, Path], window: int, fmt: str = 'csv') -> str:
+    """A name of the window for the manifests: the path of its file or, in a store, its id after the store."""
+    if is_store(directory):
+        return f"{Path(directory) / read_index(directory)['file']}#{window}"
+    return str(window_path(directory, window, fmt))
+
+
+def file_signature(path: Union[str, Path]) -> str:
+    """A cheap fingerprint of a file, that changes whenever it is rewritten."""
+    stat = Path(path).stat()
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def file_hash(path: Union[str, Path]) -> str:
+    """A hash of the content of a file, that doesn't change when the same content is written again."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def rows_hash(df: pd.DataFrame) -> str:
+    """A hash of the columns and the values of some rows (not of their index)."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update('\0'.join(map(str, df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def window_signatures(directory: Union[str, Path], windows: Iterable[int], fmt: str = 'csv') -> List[str]:
+    """Return a hash of each of the ``windows``, to tell whether they changed since a split was created.
+
+    The hash is of the content of the window (its file or, in a store, its rows), so windows rewritten as they were
+    keep theirs.
+    """
+    if not is_store(directory):
+        return [file_hash(window_path(directory, window, fmt)) for window in windows]
+    return [rows_hash(df) for _, df in iter_windows(directory, windows)]
+
+
+def window_sizes(directory: Union[str, Path], windows: Iterable[int], fmt: str = 'csv') -> List[int]:
+    """Return the bytes of each of the ``windows``: the size of its file or, in a store, its share of the store."""
+    if not is_store(directory):
+        return [window_path(directory, window, fmt).stat().st_size for window in windows]
+    index = read_index(directory)
+    rows = {window: entry['rows'] for window, entry in index['windows'].items()}
+    per_row = (Path(directory) / index['file']).stat().st_size / max(sum(rows.values()), 1)
+    return [round(rows[window] * per_row) for window in windows]
+
+
+def store_format(directory: Union[str, Path]) -> str:
+    return detect_format(read_index(directory)['file'])
+
+
+def list_windows(directory: Union[str, Path], fmt: str = 'csv') -> List[int]:
+    """Return the (sorted) windows in ``directory``, either a store or ``window-N`` files in the format ``fmt``."""
+    if is_store(directory):
+        return window_ids(directory)
+    return sorted(int(path.stem[7:]) for path in Path(directory).glob(f'window-*{EXTENSIONS[fmt]}'))
+
+
+def iter_windows(directory: Union[str, Path], windows: Iterable[int], fmt: str = 'csv',
+                 columns: Columns = None) -> Iterator[Tuple[int, pd.DataFrame]]:
+    """Yield each of the ``windows`` in ``directory`` with its rows, indexed by their position in the window."""
+    if not is_store(directory):
+        for window in windows:
+            yield window, read_table(window_path(directory, window, fmt), columns=columns)
+        return
+
+    index = read_index(directory)
+    for window in windows:
+        df = read_parts(Path(directory) / index['file'], index['windows'][window]['parts'], columns=columns)
+        yield window, df.reset_index(drop=True)